@@ -1,15 +1,20 @@
 import numpy as np
-from scipy.ndimage import generic_filter
-import scipy.stats as sts
 import time
-import matplotlib.pyplot as plt
-import tqdm
+import hashlib
 
+# The simulation core only needs numpy: scipy (create_basin, resampling), matplotlib (run_sim's
+# plot) and tqdm (progress bar) are imported where they are first used, so pool workers and
+# scripts that only step a grid do not pay for them
+from src.grid import Grid
+from src.checkpoints import save_checkpoint, load_checkpoint
+from src.forcing import Rainfall, as_rainfall, poisson_rain, circle_mask, HOUR
+from src.profiling import timed, counting, record_counters
+from src.metrics import FloodMetrics
 
 
 ############################ Init a DEM with Direction, Slope Layers ###########################
 
-def init_water(layer, fill = 1, kind = 'border'):
+def init_water(layer, fill = 1, kind = 'border', center = None, radius = None):
     # later is slice of CA with water heights
 
     water_layer = layer.copy()
@@ -23,8 +28,10 @@ def init_water(layer, fill = 1, kind = 'border'):
         water_layer[:] = fill
 
     elif kind == 'circle':
-        # generate a circle of rainfall in center
-        pass
+        # circle of water around center (row, col), by default the middle of the grid
+        inside = circle_mask(layer.shape, center, radius) > 0
+        water_layer[inside] = fill
+
     return water_layer
 
 directions = {
@@ -56,25 +63,19 @@ def find_direction(window, method  = 'Dinf'):
     return np.sum([directions[i] for i in idxs]) if len(idxs) > 0 else 0
 
 def init_directions(layer, method = 'Dinf'):
-    # idx for elevation values
-    moore_kernel = np.ones((3,3)) 
-    
-    # TODO: better cval for constant mode
-    # maybe repeat? 
-    directions = generic_filter(
-                    layer,
-                    find_direction,
-                    footprint = moore_kernel,  
-                    mode = 'constant',
-                    cval = np.nan)
-
-    # Set border of directions to 0
-    directions[0,:] = 0
-    directions[:,0] = 0
-    directions[-1,:] = 0
-    directions[:,-1] = 0
-    
-    return directions
+    # Sum of direction codes of every lower neighbour, same result as
+    # generic_filter(layer, find_direction) but one array op per neighbour
+    dir_layer = np.zeros_like(layer)
+    rows, cols = layer.shape
+
+    # only interior cells, the border of directions is 0
+    center = layer[1:-1, 1:-1]
+    for position, code in directions.items():
+        dx, dy = position // 3 - 1, position % 3 - 1
+        neighbor = layer[1+dx:rows-1+dx, 1+dy:cols-1+dy]
+        dir_layer[1:-1, 1:-1] += np.where(neighbor < center, code, 0).astype(layer.dtype)
+
+    return dir_layer
 
 def calculate_slope(window, d = 1, degrees = True):
     # d is width of a cell
@@ -100,82 +101,126 @@ def calculate_slope(window, d = 1, degrees = True):
         #return absolute value of rise/run
         return rise_run
 
-def init_slope(dem_layer):
+def init_slope(dem_layer, d = 1, degrees = True):
     # Fill out gradients (degrees) for each cell in grid
-    # idx for elevation values
+    # Same result as generic_filter(dem_layer, calculate_slope, mode = 'nearest')
+    rows, cols = dem_layer.shape
+
+    # repeat edge cells past the border, like mode = 'nearest'
+    padded = np.pad(dem_layer.astype(float), 1, mode = 'edge')
+    # window[k] is the k-th cell of every 3x3 window, in find_direction's key order
+    window = [padded[dx:dx+rows, dy:dy+cols] for dx in range(3) for dy in range(3)]
 
-    moore_kernel = np.ones((3,3))    
-    slopes = generic_filter(
-                dem_layer,
-                calculate_slope,
-                footprint = moore_kernel,  
-                mode = 'nearest',
-                cval = 0)
+    df_dx = ((window[2] + window[5] + window[5] + window[8]) - (window[0] + window[3] + window[3] + window[6]))/8*d
+    df_dy = ((window[6] + window[7] + window[7] + window[8]) - (window[0] + window[1] + window[1] + window[2]))/8*d
+
+    rise_run = np.sqrt(df_dx**2 + df_dy**2)
+    if degrees:
+        # 57.29578 ~ 180/pi (acceptable precision)
+        rise_run = np.arctan(rise_run) * 57.29578
+
+    # no_data cells keep their value
+    slopes = np.empty_like(dem_layer)
+    slopes[...] = np.where(window[4] < 0, window[4], rise_run)
 
     return slopes
     
 
+def resample_weights(n, new_n):
+    '''
+    Sparse (new_n, n) matrix that averages n cells into new_n equal bins.
+    Row j holds the portion of every old cell that overlaps bin j (the first and
+    last cell of a bin can be partial), divided by the bin's total weight.
+    '''
+    scale = float(n) / new_n
+    start = np.arange(new_n) * scale
+    end = np.arange(1, new_n + 1) * scale
+
+    first = start.astype(int)
+    last = end.astype(int)
+    # portion of the first and last cell that overlaps the bin
+    first_w = 1 - (start - first)
+    last_w = end - last
+    # a bin that ends exactly on a cell edge does not include that cell
+    last = np.where(last_w == 0, last - 1, last)
+
+    # one entry per (bin, old cell) pair
+    counts = last - first + 1
+    bins = np.repeat(np.arange(new_n), counts)
+    cells = first[bins] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    weights = np.ones(len(cells))
+    weights[cells == first[bins]] = first_w[bins][cells == first[bins]]
+    partial_last = (cells == last[bins]) & (last_w[bins] != 0)
+    weights[partial_last] = last_w[bins][partial_last]
+
+    from scipy import sparse
+
+    # rounding in scale can put the end of the last bin just past the last cell
+    inside = cells < n
+    R = sparse.csr_matrix((weights[inside], (bins[inside], cells[inside])), shape = (new_n, n))
+
+    return sparse.diags(1 / np.asarray(R.sum(axis = 1)).ravel()) @ R
+
 def resize_array(a, new_rows, new_cols): 
     '''
     This function takes an 2D numpy array a and produces a smaller array 
     of size new_rows, new_cols. new_rows and new_cols must be less than 
     or equal to the number of rows and columns in a.
 
-    From https://stackoverflow.com/questions/8090229/resize-with-averaging-or-rebin-a-numpy-2d-array
+    Every new cell is the area weighted average of the old cells it covers, as in
+    https://stackoverflow.com/questions/8090229/resize-with-averaging-or-rebin-a-numpy-2d-array
+    but done in one shot as R_rows @ a @ R_cols^T with the weights of resample_weights.
 
     '''
-    rows = len(a)
-    cols = len(a[0])
-    yscale = float(rows) / new_rows 
-    xscale = float(cols) / new_cols
-
-    # first average across the cols to shorten rows    
-    new_a = np.zeros((rows, new_cols)) 
-    for j in range(new_cols):
-        # get the indices of the original array we are going to average across
-        the_x_range = (j*xscale, (j+1)*xscale)
-        firstx = int(the_x_range[0])
-        lastx = int(the_x_range[1])
-        # figure out the portion of the first and last index that overlap
-        # with the new index, and thus the portion of those cells that 
-        # we need to include in our average
-        x0_scale = 1 - (the_x_range[0]-int(the_x_range[0]))
-        xEnd_scale =  (the_x_range[1]-int(the_x_range[1]))
-        # scale_line is a 1d array that corresponds to the portion of each old
-        # index in the_x_range that should be included in the new average
-        scale_line = np.ones((lastx-firstx+1))
-        scale_line[0] = x0_scale
-        scale_line[-1] = xEnd_scale
-        # Make sure you don't screw up and include an index that is too large
-        # for the array. This isn't great, as there could be some floating
-        # point errors that mess up this comparison.
-        if scale_line[-1] == 0:
-            scale_line = scale_line[:-1]
-            lastx = lastx - 1
-        # Now it's linear algebra time. Take the dot product of a slice of
-        # the original array and the scale_line
-        new_a[:,j] = np.dot(a[:,firstx:lastx+1], scale_line)/scale_line.sum()
-
-    # Then average across the rows to shorten the cols. Same method as above.
-    # It is probably possible to simplify this code, as this is more or less
-    # the same procedure as the block of code above, but transposed.
-    # Here I'm reusing the variable a. Sorry if that's confusing.
-    a = np.zeros((new_rows, new_cols))
-    for i in range(new_rows):
-        the_y_range = (i*yscale, (i+1)*yscale)
-        firsty = int(the_y_range[0])
-        lasty = int(the_y_range[1])
-        y0_scale = 1 - (the_y_range[0]-int(the_y_range[0]))
-        yEnd_scale =  (the_y_range[1]-int(the_y_range[1]))
-        scale_line = np.ones((lasty-firsty+1))
-        scale_line[0] = y0_scale
-        scale_line[-1] = yEnd_scale
-        if scale_line[-1] == 0:
-            scale_line = scale_line[:-1]
-            lasty = lasty - 1
-        a[i:,] = np.dot(scale_line, new_a[firsty:lasty+1,])/scale_line.sum() 
-
-    return a 
+    a = np.asarray(a, dtype = float)
+    rows, cols = a.shape
+
+    R_rows = resample_weights(rows, new_rows)
+    R_cols = resample_weights(cols, new_cols)
+
+    return np.asarray(R_rows @ a @ R_cols.T)
+
+# resampled DEMs, PYRAMID[dem_hash(dem)][(rows, cols)]. PYRAMID.clear() frees them
+PYRAMID = {}
+
+def dem_hash(dem):
+    # content hash of a DEM, same for equal arrays whatever object holds them
+    dem = np.ascontiguousarray(dem)
+    h = hashlib.sha1(f'{dem.shape}{dem.dtype.str}'.encode())
+    h.update(memoryview(dem).cast('B'))
+
+    return h.hexdigest()
+
+def resample_dem(dem, rows, cols, key = None):
+    # resize_array(dem, rows, cols), cached per DEM. A level is made from the coarsest cached level
+    # whose shape is a multiple of (rows, cols): averaging whole bins of a level gives the same
+    # value as averaging the full DEM. key is dem_hash(dem), if it is already known
+    if (rows, cols) == dem.shape:
+        return np.asarray(dem, dtype = float)
+
+    levels = PYRAMID.setdefault(key or dem_hash(dem), {})
+    if (rows, cols) not in levels:
+        sources = [shape for shape in levels if shape[0] % rows == 0 and shape[1] % cols == 0]
+        source = levels[min(sources, key = np.prod)] if sources else dem
+        levels[(rows, cols)] = resize_array(source, rows, cols)
+        # levels are shared between callers, copy one before changing it
+        levels[(rows, cols)].flags.writeable = False
+
+    return levels[(rows, cols)]
+
+def dem_pyramid(dem, min_size = 8, factor = 2):
+    # Levels of a DEM from full resolution down to min_size cells along the shortest side,
+    # every level factor times coarser than the one before and made from it when the sizes allow
+    key = dem_hash(dem)
+    rows, cols = dem.shape
+
+    pyramid = [np.asarray(dem, dtype = float)]
+    while min(rows, cols) // factor >= min_size:
+        rows, cols = rows // factor, cols // factor
+        pyramid.append(resample_dem(dem, rows, cols, key = key))
+
+    return pyramid
 
 
 
@@ -189,6 +234,8 @@ def create_basin(N = 5, layers = 4, seed = 1):
     # Return a toy elevation model
     # layers can be :[DEM, WaterCol, Flooded?, Direction, Slope]
     
+    import scipy.stats as sts
+
     #set seed for reproducibility
     np.random.seed(seed)
 
@@ -232,13 +279,65 @@ def init_grid(grid, **kwargs):
     fill = kwargs.get('fill', 1)
     kind = kwargs.get('kind', 'border')
 
-    grid[...,1] = init_water(grid[...,1], fill = fill, kind = kind)
-    grid[...,2] = init_slope(grid[...,0])
-    grid[...,3] = init_directions(grid[...,0])
+    grid[...,1] = init_water(grid[...,1], fill = fill, kind = kind,
+                             center = kwargs.get('center'), radius = kwargs.get('radius'))
+
+    # slope and directions only depend on the DEM, a grid_cache.GridCache keeps them between calls
+    # (and sessions): the cache key is the DEM's content hash
+    cache = kwargs.get('cache')
+    layers = None
+    if cache is not None:
+        key = cache.key(dem_hash(grid[...,0]), 'layers')
+        layers = cache.get(key)
+    if layers is None:
+        layers = {'slope': init_slope(grid[...,0]), 'directions': init_directions(grid[...,0])}
+        if cache is not None:
+            cache.put(key, layers)
+
+    grid[...,2] = layers['slope']
+    grid[...,3] = layers['directions']
+
+    # layout = 'layers' returns a Grid with one contiguous array per layer,
+    # float32 by default and uint8 directions (slope_dtype = np.float16 halves slope again).
+    # float32 water conserves mass but crosses tau at slightly different steps than float64,
+    # so use dtype = np.float64 to reproduce interleaved runs exactly
+    if kwargs.get('layout', 'interleaved') == 'layers' and not isinstance(grid, Grid):
+        grid = Grid.from_array(
+            grid,
+            dtype = kwargs.get('dtype', np.float32),
+            slope_dtype = kwargs.get('slope_dtype'))
     
     return grid
     
 
+def edit_dem(grid, key, value, topology = None):
+    # Change part of the DEM in place, e.g. a dam: edit_dem(grid, np.s_[55:75, 45], 500)
+    # does grid[55:75, 45, 0] = 500. Slope and directions only depend on the 3x3 window around
+    # a cell, so they are recomputed for the edited box plus a one cell margin only.
+    # An init_topology index of the grid's DEM is patched the same way.
+    # Returns the (first row, last row + 1, first col, last col + 1) of the recomputed box
+    rows, cols = grid[...,0].shape
+    grid[key + (0,)] = value
+
+    # bounding box of the edited cells grown by the margin
+    edited_rows, edited_cols = np.arange(rows)[key[0]], np.arange(cols)[key[1]]
+    r0, r1 = max(int(np.min(edited_rows)) - 1, 0), min(int(np.max(edited_rows)) + 2, rows)
+    c0, c1 = max(int(np.min(edited_cols)) - 1, 0), min(int(np.max(edited_cols)) + 2, cols)
+
+    # the margin cells need their own neighbours too
+    top, left = max(r0 - 1, 0), max(c0 - 1, 0)
+    block = np.asarray(grid[top:min(r1 + 1, rows), left:min(c1 + 1, cols), 0])
+    own = (slice(r0 - top, r1 - top), slice(c0 - left, c1 - left))
+
+    grid[r0:r1, c0:c1, 2] = init_slope(block)[own]
+    grid[r0:r1, c0:c1, 3] = init_directions(block)[own]
+
+    if topology is not None:
+        patch_topology(topology, block, (top, left), (r0, r1, c0, c1), (rows, cols))
+
+    return r0, r1, c0, c1
+
+
 
 ############################ Testing ###########################################################
 
@@ -269,17 +368,94 @@ def make_direction_dict():
 
     return ij_dict
 
-def generate_flow_acc(dir_grid, n_iters = 10000, max_visits = 5, random = True):
+# (di, dj) of the neighbour each bit of a direction code points to, bit 0 (code 1) first
+DIRECTION_OFFSETS = [(position // 3 - 1, position % 3 - 1) for position in sorted(directions)]
+
+def direction_pairs(dir_grid):
+    # (cell, receiver) flat index pairs for every bit set in a direction grid
+    rows, cols = dir_grid.shape
+    codes = dir_grid.astype(np.int64).ravel()
+    i, j = np.divmod(np.arange(rows*cols), cols)
+
+    cell, receiver = [], []
+    for bit, (di, dj) in enumerate(DIRECTION_OFFSETS):
+        ni, nj = i + di, j + dj
+        flows = ((codes >> bit) & 1 == 1) & (0 <= ni) & (ni < rows) & (0 <= nj) & (nj < cols)
+        cell.append(np.flatnonzero(flows))
+        receiver.append(ni[flows] * cols + nj[flows])
+
+    return np.concatenate(cell), np.concatenate(receiver)
+
+def flow_accumulation(dir_grid, dem = None):
+    # Exact number of upstream cells draining through each cell of a direction grid.
+    # A cell passes on its own unit of flow plus everything it received, split equally between
+    # its receivers (like the random walker's choice), or by elevation drop if dem is given.
+    # Cells are visited in waves: a cell is processed once all of its donors have been.
+    rows, cols = dir_grid.shape
+    size = rows*cols
+    cell, receiver = direction_pairs(dir_grid)
+
+    if dem is None:
+        fraction = 1 / np.bincount(cell, minlength = size)[cell]
+    else:
+        dem = np.asarray(dem, dtype = float).ravel()
+        drop = np.maximum(dem[cell] - dem[receiver], 0)
+        total_drop = np.bincount(cell, weights = drop, minlength = size)[cell]
+        equal = 1 / np.bincount(cell, minlength = size)[cell]
+        fraction = np.where(total_drop > 0, drop / np.where(total_drop > 0, total_drop, 1), equal)
+
+    # out-edges of each cell, CSR style
+    order = np.argsort(cell, kind = 'stable')
+    cell, receiver, fraction = cell[order], receiver[order], fraction[order]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(cell, minlength = size))))
+
+    donors_left = np.bincount(receiver, minlength = size)
+    flow_acc = np.zeros(size)
+
+    # start from cells nothing drains into
+    wave = np.flatnonzero(donors_left == 0)
+    while len(wave):
+        counts = offsets[wave + 1] - offsets[wave]
+        edges = np.repeat(offsets[wave], counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        np.add.at(flow_acc, receiver[edges], (flow_acc[cell[edges]] + 1) * fraction[edges])
+        np.subtract.at(donors_left, receiver[edges], 1)
+
+        # receivers whose donors are all done form the next wave
+        wave = np.unique(receiver[edges])
+        wave = wave[donors_left[wave] == 0]
+
+    return flow_acc.reshape(rows, cols)
+
+def generate_flow_acc(dir_grid, n_iters = 10000, max_visits = 5, random = True, exact = False,
+                      batch_size = None, seed = None, batches = None):
     # Generate flow accumulation grid
+    # exact = True returns the deterministic flow_accumulation instead of random walkers
+    # batch_size advances that many walkers at once (see walk_batch). Batch k always uses the
+    # k-th stream spawned from seed, so running disjoint lists of batches (e.g. one per process)
+    # and adding the results reproduces a single run exactly
+    if exact:
+        return flow_accumulation(dir_grid)
+
+    if batch_size is not None:
+        if not random:
+            raise ValueError('Batched walkers start from random cells, batch_size needs random = True')
+        n_batches = -(-n_iters // batch_size)
+        streams = np.random.SeedSequence(seed).spawn(n_batches)
+        table = walker_table()
+
+        flow_acc = np.zeros(dir_grid.shape)
+        for k in (range(n_batches) if batches is None else batches):
+            n_walkers = min(batch_size, n_iters - k*batch_size)
+            flow_acc += walk_batch(dir_grid, n_walkers, max_visits, np.random.default_rng(streams[k]), table)
+
+        return flow_acc
 
     # Take a direction grid and generate flow accumulation grid
     N = dir_grid.shape[0]
     # Init flow accumulation matrix
     flow_acc = np.zeros((N,N))
 
-
-    ij_dict = make_direction_dict()
-
     # pick a random cell
     x = np.random.randint(0, N)
     y = np.random.randint(0, N)
@@ -304,7 +480,7 @@ def generate_flow_acc(dir_grid, n_iters = 10000, max_visits = 5, random = True):
                 # performance: choose a neighbor to flow to first
                 key_idx = np.random.choice(len(dir_keys))
                 key = dir_keys[key_idx]
-                dx, dy = get_direction_idxs(key, ij_dict)
+                dx, dy = DIRECTION_OFFSETS[key]
 
                 downstream_neighbor = [i+dx, j+dy]
 
@@ -323,147 +499,819 @@ def generate_flow_acc(dir_grid, n_iters = 10000, max_visits = 5, random = True):
     return flow_acc
 
 
+def walker_table():
+    # Moves a walker can take from each of the 256 direction codes, decoded with DIRECTION_OFFSETS
+    # like generate_flow_acc's walkers. Returns the number of choices per code and the (di, dj) of each choice
+    n_choices = np.zeros(256, dtype = int)
+    di = np.zeros((256, 8), dtype = int)
+    dj = np.zeros((256, 8), dtype = int)
+
+    for code in range(256):
+        keys = get_direction_keys(code) or []
+        n_choices[code] = len(keys)
+        for k, key in enumerate(keys):
+            di[code, k], dj[code, k] = DIRECTION_OFFSETS[key]
+
+    return n_choices, di, dj
+
+def walk_batch(dir_grid, n_walkers, max_visits, rng, table = None):
+    # Advance n_walkers random walkers together, returns how often each cell was visited
+    rows, cols = dir_grid.shape
+    codes = dir_grid.astype(np.int64)
+    n_choices, di, dj = walker_table() if table is None else table
+
+    flow_acc = np.zeros(rows*cols)
+
+    # every walker starts at a random cell
+    i = rng.integers(0, rows, n_walkers)
+    j = rng.integers(0, cols, n_walkers)
+
+    for _ in range(max_visits):
+        code = codes[i, j]
+        # walkers on cells without downstream neighbours stop
+        moving = n_choices[code] > 0
+        i, j, code = i[moving], j[moving], code[moving]
+        if len(i) == 0:
+            break
+
+        # pick one of the downstream neighbours uniformly
+        choice = (rng.random(len(code)) * n_choices[code]).astype(int)
+        i = i + di[code, choice]
+        j = j + dj[code, choice]
+
+        # retire walkers that leave the grid
+        inside = (0 <= i) & (i < rows) & (0 <= j) & (j < cols)
+        i, j = i[inside], j[inside]
+
+        np.add.at(flow_acc, i*cols + j, 1)
+
+    return flow_acc.reshape(rows, cols)
+
+
 ##### Run CA ##################################################################################
 
+# Neighbour offsets (di, dj) in the same order the loop engine visits them
+NEIGHBOURS = [(dx, dy) for dx in range(-1,2) for dy in range(-1,2) if (dx, dy) != (0, 0)]
+
+def record_flow(state, velocity, moved):
+    # Summary of a step for run_sim: fastest flow (m/s) and largest volume that left a cell
+    if state is not None:
+        state['max_velocity'] = float(np.max(velocity, initial = 0))
+        state['max_moved'] = float(np.max(moved, initial = 0))
+
+def step_loop(dem, water, tau, t, n, g = 10, edgel = 1, state = None):
+    # Reference engine: visit every cell and push water to its lower neighbours
+    area = edgel*edgel
+    dist = edgel
+
+    max_velocity = 0
+    max_moved = 0
+    # counters for a profiled run
+    outflow_cells = 0
+    volume_moved = 0
+    max_ic_vol = 0
+
+    rows, cols = dem.shape
+    water_heights = dem + water
+
+    # make a copy of basin
+    basin_copy = water.copy()
+
+    for i in range(rows):
+        for j in range(cols):
+            central_height = water_heights[i,j]
+            
+            # store downstream neighbors
+            v = []
+            # calculate height difference between central cell and neighbors
+            for dx in range(-1,2):
+                for dy in range(-1,2):
+                    # if neighbor is in bounds
+                    if 0 <= i+dx < rows and 0 <= j+dy < cols:
+                        neighbor_height = water_heights[i+dx,j+dy]
+                        # if neighbor is not no_data
+                        if neighbor_height > 0:
+                            # calculate difference
+                            diff = central_height - neighbor_height
+                            # exclude self
+                            if diff - tau > 0:
+                                v.append(((i + dx, j + dy), diff * area))
+                
+            # sum up differences to find total available volume
+            v_tot_avail = np.sum([x[1] for x in v])
+
+            # minimum in v
+            try: 
+                v_min = min([x[1] for x in v])
+            except: 
+                v_min = 0.01
+            try:
+                v_max = max([x[1] for x in v])
+            except:
+                # possibly np.inf
+                v_max = 1e4
+            
+            # calculate weight for each downstream neighbor
+            weights = [(x[0], x[1]/(v_tot_avail + v_min)) for x in v]
+            min_weight = v_min/(v_tot_avail + v_min)
+            weights.append(((i,j),  min_weight))
+    
+            w_max = max([x[1] for x in weights])
+
+            # do weights sum to 1
+            #assert round(np.array([x[1] for x in weights]).sum()) == 1
+
+            
+
+            central_depth = water[i,j]
+
+            manning = 1/n * central_depth**(2/3) * np.sqrt(v_max / dist)
+            # maximum permissible velocity
+            vm = min(np.sqrt(central_depth*g), manning)
+
+            inter_cell_max = vm * central_depth * t * edgel
+
+            v_incell = central_depth * area
+
+            ic_vol = min(v_incell, inter_cell_max/w_max, v_min)
+
+            # only cells with downstream neighbours actually move water
+            if v:
+                moved = ic_vol * (1 - min_weight)
+                max_velocity = max(max_velocity, vm)
+                max_moved = max(max_moved, moved)
+                outflow_cells += moved > 0
+                volume_moved += moved
+                max_ic_vol = max(max_ic_vol, ic_vol)
+
+            # update water column in neighbors
+            for x in weights:
+                ii,jj = x[0]
+                if i == ii and j == jj:
+                    # update water column in central cell
+                    basin_copy[ii,jj] -= ic_vol/area
+                # update water column in neighbors
+                basin_copy[ii,jj] += ic_vol * x[1] / area
+
+    record_flow(state, max_velocity, max_moved)
+    record_counters(state, rows*cols, outflow_cells, volume_moved, max_ic_vol)
+
+    return basin_copy
+
+def shifted(layer, dx, dy, fill = 0):
+    # Return layer[i+dx, j+dy] for every cell, fill where the neighbour is out of bounds.
+    # Only the last two axes are shifted, so a stack of (trials, rows, cols) layers works too
+    out = np.full(layer.shape, fill, dtype = layer.dtype)
+    rows, cols = layer.shape[-2:]
+
+    out[..., max(-dx,0):rows - max(dx,0), max(-dy,0):cols - max(dy,0)] = \
+        layer[..., max(dx,0):rows + min(dx,0), max(dy,0):cols + min(dy,0)]
+
+    return out
+
+def cell_outflows(water_heights, water, tau, t, n, g = 10, edgel = 1, state = None):
+    # Per-cell half of the update rule for a whole grid (or block with a halo).
+    # Returns vols, the height difference * area to each neighbour (0 where it is not downstream),
+    # share, the volume each neighbour gets per unit of vols, and kept, the water left in the cell.
+    area = edgel*edgel
+    dist = edgel
+
+    # (rows, cols), or (trials, rows, cols) for a stack of water layers on the same DEM
+    shape = water_heights.shape
+
+    # out of bounds neighbours are filled with 0 so they fail the no_data check
+    vols = np.zeros((len(NEIGHBOURS),) + shape, dtype = water_heights.dtype)
+    downstream = np.zeros((len(NEIGHBOURS),) + shape, dtype = bool)
+    with timed(state, 'neighbours'):
+        for k, (dx, dy) in enumerate(NEIGHBOURS):
+            neighbor_height = shifted(water_heights, dx, dy)
+            diff = water_heights - neighbor_height
+            downstream[k] = (neighbor_height > 0) & (diff - tau > 0)
+            vols[k] = np.where(downstream[k], diff * area, 0)
+
+    with timed(state, 'weights'):
+        has_downstream = downstream.any(axis = 0)
+
+        v_tot_avail = vols.sum(axis = 0)
+        v_min = np.where(has_downstream, np.where(downstream, vols, np.inf).min(axis = 0), 0.01)
+        v_max = np.where(has_downstream, np.where(downstream, vols, -np.inf).max(axis = 0), 1e4)
+
+        # weight of the central cell and largest weight overall
+        min_weight = v_min / (v_tot_avail + v_min)
+        w_max = np.where(has_downstream, v_max / (v_tot_avail + v_min), min_weight)
+
+        central_depth = water
+        manning = 1/n * central_depth**(2/3) * np.sqrt(v_max / dist)
+        # maximum permissible velocity
+        vm = np.minimum(np.sqrt(central_depth*g), manning)
+        inter_cell_max = vm * central_depth * t * edgel
+        v_incell = central_depth * area
+
+        ic_vol = np.minimum(np.minimum(v_incell, inter_cell_max/w_max), v_min)
+
+        share = ic_vol / (v_tot_avail + v_min)
+        # central cell keeps its own share of ic_vol
+        kept = water - ic_vol/area + ic_vol * min_weight / area
+
+    moved = ic_vol * (1 - min_weight)
+    record_flow(state, vm[has_downstream], moved)
+    if counting(state):
+        record_counters(state, moved.size, np.count_nonzero(moved > 0), moved.sum(),
+                        np.max(ic_vol[has_downstream], initial = 0))
+
+    return vols, share, kept
+
+def step_numpy(dem, water, tau, t, n, g = 10, edgel = 1, state = None):
+    # Whole-grid engine: same update rule as step_loop, one array op per neighbour direction.
+    # water can also be a (trials, rows, cols) stack, the DEM is then broadcast over the trials
+    # and every trial advances in the same array ops
+    area = edgel*edgel
+
+    water_heights = dem + water
+    rows, cols = water_heights.shape[-2:]
+
+    vols, share, basin_copy = cell_outflows(water_heights, water, tau, t, n, g = g, edgel = edgel, state = state)
+
+    # scatter outflows to neighbours, one accumulation per direction
+    with timed(state, 'scatter'):
+        for k, (dx, dy) in enumerate(NEIGHBOURS):
+            outflow = share * vols[k] / area
+            basin_copy[..., max(-dx,0) + dx:rows - max(dx,0) + dx, max(-dy,0) + dy:cols - max(dy,0) + dy] += \
+                outflow[..., max(-dx,0):rows - max(dx,0), max(-dy,0):cols - max(dy,0)]
+
+    return basin_copy
+
+def gather_inflows(water_heights, share, kept, tau):
+    # Other half of the update rule as a gather: each cell pulls water from its upstream neighbours.
+    # Used where cells are updated by different processes, so nobody writes outside their own block
+    basin_copy = kept.copy()
+
+    for dx, dy in NEIGHBOURS:
+        # same test the upstream cell used to pick its downstream neighbours
+        diff = shifted(water_heights, dx, dy) - water_heights
+        upstream = (water_heights > 0) & (diff - tau > 0)
+        # depth gained is share * vols / area, and vols is diff * area
+        basin_copy += np.where(upstream, shifted(share, dx, dy) * diff, 0)
+
+    return basin_copy
+
+def neighbour_pairs(idx, rows, cols):
+    # In-bounds (cell, neighbour) pairs for flat cell indices, grouped by cell
+    # returns position of the cell in idx and flat index of the neighbour
+    i, j = np.divmod(idx, cols)
+    di = np.array([dx for dx, dy in NEIGHBOURS])
+    dj = np.array([dy for dx, dy in NEIGHBOURS])
+
+    ni = i[:,None] + di
+    nj = j[:,None] + dj
+    in_bounds = (0 <= ni) & (ni < rows) & (0 <= nj) & (nj < cols)
+
+    pos, k = np.nonzero(in_bounds)
+    return pos, ni[pos, k] * cols + nj[pos, k]
+
+def init_topology(dem, cache = None):
+    # CSR index of candidate receivers for each cell of a DEM:
+    # candidates of cell c are nbrs[offsets[c]:offsets[c+1]].
+    # A neighbour can only receive water if its surface is below the central cell's, so only the
+    # strictly lower neighbours are stored (the same cells as the directions bitmask).
+    # headroom is how far the lowest excluded neighbour rises above the cell, once the water
+    # column is deeper than that update_topology marks the cell as spilled.
+    # With a grid_cache.GridCache the index is read from it (memory mapped) when the DEM is known
+    rows, cols = dem.shape
+
+    if cache is not None:
+        key = cache.key(dem_hash(dem), 'topology')
+        stored = cache.get(key)
+        if stored is None:
+            built = init_topology(dem)
+            stored = cache.put(key, {k: built[k] for k in ['offsets', 'nbrs', 'headroom']})
+        return {
+            'offsets': stored['offsets'],
+            'nbrs': stored['nbrs'],
+            # updated while stepping
+            'headroom': np.array(stored['headroom']),
+            'spilled': np.zeros(rows*cols, dtype = bool),
+        }
+
+    flat = dem.ravel()
+
+    cell, nbr = neighbour_pairs(np.arange(rows*cols), rows, cols)
+    rise = flat[nbr] - flat[cell]
+    candidate = rise < 0
+
+    headroom = np.full(rows*cols, np.inf)
+    np.minimum.at(headroom, cell[~candidate], rise[~candidate])
+
+    return {
+        'offsets': np.concatenate(([0], np.cumsum(np.bincount(cell[candidate], minlength = rows*cols)))),
+        'nbrs': nbr[candidate],
+        'headroom': headroom,
+        # cells whose water is above some excluded neighbour use all their neighbours
+        'spilled': np.zeros(rows*cols, dtype = bool),
+    }
+
+def update_topology(topology, depth, cells, tau):
+    # Mark cells whose water column may now spill into a higher neighbour
+    spill = cells[depth[cells] - tau > topology['headroom'][cells]]
+    topology['spilled'][spill] = True
+    # spilled cells already look at every neighbour
+    topology['headroom'][spill] = np.inf
+
+    return topology
+
+def patch_topology(topology, block, corner, box, shape):
+    # Rebuild the rows of an init_topology index for the cells in box after a DEM edit.
+    # block is the DEM around box (with the neighbours of its cells), corner the grid position
+    # of block[0, 0]. Rows outside box are copied over, not recomputed
+    rows, cols = shape
+    r0, r1, c0, c1 = box
+    top, left = corner
+    flat = block.ravel()
+
+    # the box's cells in block coordinates
+    local = ((np.arange(r0, r1)[:,None] - top) * block.shape[1] + np.arange(c0, c1) - left).ravel()
+    pos, local_nbr = neighbour_pairs(local, *block.shape)
+    rise = flat[local_nbr] - flat[local[pos]]
+    candidate = rise < 0
+    # back to flat grid indices
+    nbr = (local_nbr // block.shape[1] + top) * cols + local_nbr % block.shape[1] + left
+
+    cells = ((np.arange(r0, r1)[:,None]) * cols + np.arange(c0, c1)).ravel()
+    headroom = np.full(len(cells), np.inf)
+    np.minimum.at(headroom, pos[~candidate], rise[~candidate])
+    topology['headroom'][cells] = headroom
+    # the frontier engine marks them again once their water rises above the new headroom
+    topology['spilled'][cells] = False
+
+    counts = np.diff(topology['offsets'])
+    counts[cells] = np.bincount(pos[candidate], minlength = len(cells))
+
+    # each row of the box is a contiguous run of cells, splice its new rows between the old ones
+    offsets, nbrs = topology['offsets'], topology['nbrs']
+    new_nbrs = nbr[candidate]
+    new_offsets = np.concatenate(([0], np.cumsum(counts[cells])))
+    pieces, prev = [], 0
+    for r in range(r1 - r0):
+        first, last = (r0 + r) * cols + c0, (r0 + r) * cols + c1
+        pieces.append(nbrs[prev:offsets[first]])
+        pieces.append(new_nbrs[new_offsets[r * (c1 - c0)]:new_offsets[(r + 1) * (c1 - c0)]])
+        prev = offsets[last]
+    pieces.append(nbrs[prev:])
+
+    topology['nbrs'] = np.concatenate(pieces)
+    topology['offsets'] = np.concatenate(([0], np.cumsum(counts)))
+
+    return topology
+
+def candidate_pairs(topology, idx, rows, cols):
+    # (position in idx, neighbour) pairs of candidate receivers, grouped by position
+    spilled = topology['spilled'][idx]
+    stored = np.flatnonzero(~spilled)
+
+    # read the stored rows
+    offsets = topology['offsets']
+    counts = offsets[idx[stored] + 1] - offsets[idx[stored]]
+    pos = np.repeat(stored, counts)
+    # index into nbrs: row start + position within the row
+    within = np.arange(len(pos)) - np.repeat(np.cumsum(counts) - counts, counts)
+    nbr = topology['nbrs'][np.repeat(offsets[idx[stored]], counts) + within]
+
+    if spilled.any():
+        spilled = np.flatnonzero(spilled)
+        spilled_pos, spilled_nbr = neighbour_pairs(idx[spilled], rows, cols)
+
+        pos = np.concatenate((pos, spilled[spilled_pos]))
+        nbr = np.concatenate((nbr, spilled_nbr))
+        order = np.argsort(pos, kind = 'stable')
+        pos, nbr = pos[order], nbr[order]
+
+    return pos, nbr
+
+def step_frontier(dem, water, tau, t, n, g = 10, edgel = 1, state = None):
+    # Same update rule as step_loop, but only cells in the active set are evaluated.
+    # The active set holds wet cells next to a cell that exchanged water in the last step,
+    # every other cell has the same neighbourhood as before and therefore still has no outflow.
+    area = edgel*edgel
+    dist = edgel
+
+    if state is None:
+        state = {}
+
+    rows, cols = water.shape
+    water_heights = (dem + water).ravel()
+    depth = water.ravel()
+    basin_copy = water.flatten()
+
+    # dry cells never have outflow, so start from every wet cell
+    active = state.get('active')
+    if active is None:
+        active = np.flatnonzero(depth > 0)
+
+    with timed(state, 'neighbours'):
+        # only look at candidate receivers, built once per DEM and updated where water spills over
+        topology = state.get('topology')
+        if topology is None:
+            topology = state['topology'] = init_topology(dem, cache = state.get('cache'))
+        update_topology(topology, depth, active, tau)
+
+        pos, nbr = candidate_pairs(topology, active, rows, cols)
+
+        # keep downstream neighbours only
+        neighbor_height = water_heights[nbr]
+        diff = water_heights[active][pos] - neighbor_height
+        downstream = (neighbor_height > 0) & (diff - tau > 0)
+        pos, nbr, vols = pos[downstream], nbr[downstream], diff[downstream] * area
+
+    with timed(state, 'weights'):
+        # pairs are grouped by active cell, so reduce over each group
+        counts = np.bincount(pos, minlength = len(active))
+        has_downstream = counts > 0
+        starts = (np.cumsum(counts) - counts)[has_downstream]
+
+        v_tot_avail = np.bincount(pos, weights = vols, minlength = len(active)).astype(vols.dtype)
+        v_min = np.full(len(active), 0.01, dtype = vols.dtype)
+        v_max = np.full(len(active), 1e4, dtype = vols.dtype)
+        if len(vols) > 0:
+            v_min[has_downstream] = np.minimum.reduceat(vols, starts)
+            v_max[has_downstream] = np.maximum.reduceat(vols, starts)
+
+        min_weight = v_min / (v_tot_avail + v_min)
+        w_max = np.where(has_downstream, v_max / (v_tot_avail + v_min), min_weight)
+
+        central_depth = depth[active]
+        manning = 1/n * central_depth**(2/3) * np.sqrt(v_max / dist)
+        # maximum permissible velocity
+        vm = np.minimum(np.sqrt(central_depth*g), manning)
+        inter_cell_max = vm * central_depth * t * edgel
+        v_incell = central_depth * area
+
+        ic_vol = np.minimum(np.minimum(v_incell, inter_cell_max/w_max), v_min)
+
+    with timed(state, 'scatter'):
+        # central cell keeps its own share, neighbours get the rest
+        basin_copy[active] += - ic_vol/area + ic_vol * min_weight / area
+        flow = ic_vol[pos] * vols / (v_tot_avail + v_min)[pos] / area
+        np.add.at(basin_copy, nbr, flow)
+
+    # cells that exchanged water, and their neighbours, may flow in the next step
+    outflow = ic_vol * (1 - min_weight)
+    record_flow(state, vm[has_downstream], outflow)
+    if counting(state):
+        record_counters(state, len(active), np.count_nonzero(outflow > 0), outflow.sum(),
+                        np.max(ic_vol[has_downstream], initial = 0))
+
+    with timed(state, 'frontier'):
+        changed = np.union1d(active[outflow > 0], nbr[flow > 0])
+        _, changed_nbrs = neighbour_pairs(changed, rows, cols)
+        active = np.union1d(changed, changed_nbrs)
+        state['active'] = active[basin_copy[active] > 0]
+
+    return basin_copy.reshape(water.shape)
+
+def step_numba(dem, water, tau, t, n, g = 10, edgel = 1, state = None):
+    # Compiled engine, parallel over row tiles. numba is only needed if this engine is used
+    from src.numba_kernels import step_tiles
+
+    return step_tiles(dem, water, tau, t, n, g = g, edgel = edgel, state = state)
+
+ENGINES = {
+    'loop': step_loop,
+    'numpy': step_numpy,
+    'numba': step_numba,
+    'frontier': step_frontier,
+}
+
+def get_rain(it, avg = 700, rng = np.random):
+    # Rainfall (m) in minute it of a random hour, for a month with avg (mm) of rain:
+    # nested Poisson draws for the days of a month, hours of a day and minutes of an hour.
+    # run_sim draws the rain of a whole run at once with forcing.poisson_rain, which has the
+    # same distribution for every minute (and minutes independent, like calls of this function)
+    it = int(it % 60)
+    # poisson distribution for days in a month
+    monthly_rainfall = rng.poisson(lam=avg/30, size=30)
+
+    # sample a day from monthly_rainfall
+    day = rng.choice(len(monthly_rainfall))
+
+    # poisson distribution for rainfall each hour
+    daily_rainfall = rng.poisson(lam=monthly_rainfall[day]/12, size=12)
+
+    # sample an hour from daily_rainfall
+    hour = rng.choice(len(daily_rainfall))
+    # poisson distribution for rainfall each minute
+    hourly_rainfall = rng.poisson(lam=daily_rainfall[hour]/60, size=60)
+
+    rain_m = hourly_rainfall[it]
+
+    return rain_m / 1000
+
+def courant_step(velocity, t, cfl = 0.5, edgel = 1):
+    # Largest step (at most t) in which water moving at velocity (m/s) crosses at most cfl cells
+    if velocity <= 0:
+        return t
+    return min(t, cfl * edgel / velocity)
+
 # Optimization stratgies:
-# Cache neighbors. You will *never* need to look at taller neighbors, even when full. So, cache downstream neighbors instead of iterating through all.
+# Cache neighbors. Taller neighbors only matter once the water column rises above them,
+# so the frontier engine caches downstream neighbors (init_topology) instead of iterating through all.
+def progress_bar(iterable, enabled = True):
+    # tqdm progress bar over iterable, tqdm is only imported when the bar is shown
+    if not enabled:
+        return iterable
+    import tqdm
+    return tqdm.tqdm(iterable)
+
 def run_sim(basin, **kwargs):
 
+    # resume_from is a checkpoint written by a run with checkpoint = path. The run carries on from
+    # its state with its parameters, unless they are given again (e.g. a larger iter to extend it).
+    # basin can be None, otherwise the checkpoint's layers are copied into it
+    resume = None
+    if kwargs.get('resume_from') is not None:
+        resume = load_checkpoint(kwargs['resume_from'])
+        kwargs = {**resume['params'], **kwargs}
+        if basin is None:
+            basin = resume['basin']
+        else:
+            for k in range(resume['basin'].shape[-1]):
+                basin[...,k] = resume['basin'][...,k]
+        if resume['rng'] is not None and kwargs.get('trials', 1) == 1:
+            kwargs.setdefault('rng', resume['rng'])
+
     #### Parameters ####
     # difference threshold to limit oscillations
     tau = kwargs.get('tau', 0.1)
     t = kwargs.get('t', 1)
 
-    edgel = 1
+    # cell size (m)
+    edgel = kwargs.get('edgel', 1)
     area = edgel*edgel
-    dist = edgel
 
     g = 10
     # Manning's roughness coefficient
     n = kwargs.get('n', 0.02)
 
+    # 'loop' is the reference implementation, 'numpy' updates the whole grid at once,
+    # 'numba' runs a compiled kernel on all cores, 'frontier' only visits cells near moving water
+    engine = kwargs.get('engine', 'loop')
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown engine {engine}, expected one of {list(ENGINES)}')
+    step = ENGINES[engine]
+
+    # with adaptive = True, t is the largest step and each step is shortened so that
+    # the fastest flow of the previous step (sqrt(g h) or Manning) crosses at most cfl cells
+    adaptive = kwargs.get('adaptive', False)
+    cfl = kwargs.get('cfl', 0.5)
+    # stop early once no cell sends more than tol (m^3) to its neighbours in a step
+    tol = kwargs.get('tol', None)
+
+    # rain is a forcing.Rainfall (or an array of rain per step, see forcing.as_rainfall)
+    # added to the water every step. With avg, the average monthly rainfall (mm), rain is drawn
+    # for the whole run with forcing.poisson_rain. None for no rain
+    rain = as_rainfall(kwargs.get('rain'))
+    avg = kwargs.get('avg')
+    rng = kwargs.get('rng', np.random.default_rng())
+
+    # with trials > 1 a (trials, rows, cols) stack of water layers is advanced in the same numpy
+    # step, each trial with its own rain stream spawned from seed (the streams run_ensemble uses),
+    # and the series come back with the trials first
+    trials = kwargs.get('trials', 1)
+    batch = () if trials == 1 else (trials,)
+    if trials > 1:
+        rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(kwargs.get('seed')).spawn(trials)]
+        if resume is not None and resume['rng'] is not None:
+            rngs = resume['rng']
+
     iter  = kwargs.get('iter', 60)
-    tot_mass = np.zeros(iter)
+    # water depths (m) above which a cell counts as flooded
+    thresholds = kwargs.get('thresh', [0.1, 0.5, 1., 5.])
+    tot_mass = np.zeros((iter,) + batch)
+    frac_flooded = np.zeros((iter,) + batch + (len(thresholds),))
+    # simulated time (s) at the end of each iteration, floats even for an integer t as
+    # adaptive steps are fractions of it
+    sim_time = t * np.arange(1, iter + 1, dtype = float)
     
     target_cell = kwargs.get('target_cell', [5,5])
-    cell_water = np.zeros(iter)
+    cell_water = np.zeros((iter,) + batch)
+
+    # flood_maps = True keeps per-cell maps of the deepest water, the time each cell first went over
+    # flood_depth (m) and how long it stayed over it. probes, a list of (row, col), and regions,
+    # boolean masks or indices like np.s_[10:20, 5:8], get a depth series (mean depth for regions)
+    flood_depth = kwargs.get('flood_depth', thresholds[0] if len(thresholds) else 0.1)
+    flood_maps = kwargs.get('flood_maps', False)
+    probes = [list(map(int, cell)) for cell in kwargs.get('probes', [])]
+    regions = kwargs.get('regions', [])
+    metrics = FloodMetrics(batch + basin[...,0].shape, iter, flood_depth = flood_depth,
+                           maps = flood_maps, probes = probes, regions = regions)
+
+    # with checkpoint = path the state is saved there every checkpoint_interval steps and at the end
+    checkpoint = kwargs.get('checkpoint')
+    checkpoint_interval = kwargs.get('checkpoint_interval', 50)
+    params = {
+        'tau': tau, 't': t, 'n': n, 'edgel': edgel, 'engine': engine,
+        'adaptive': adaptive, 'cfl': cfl, 'tol': tol, 'avg': avg,
+        'trials': trials, 'seed': kwargs.get('seed'), 'iter': iter,
+        'thresh': list(thresholds), 'target_cell': list(target_cell), 'interval': kwargs.get('interval', 10),
+        # regions are passed again when resuming
+        'flood_depth': flood_depth, 'flood_maps': flood_maps, 'probes': probes,
+    }
+
+    # steps already done by the run being resumed
+    first = 0
+    if resume is not None:
+        first = resume['iteration']
+        if first > iter:
+            raise ValueError(f'Checkpoint is at step {first}, past iter = {iter}')
+        series = resume['series']
+        tot_mass[:first], cell_water[:first] = series['tot_mass'], series['cell_water']
+        frac_flooded[:first], sim_time[:first] = series['frac_flooded'], series['sim_time']
+        metrics.restore({key[len('metric_'):]: value for key, value in series.items() if key.startswith('metric_')}, first)
+
+    # rain drawn here is stored in checkpoints, other forcings are passed again when resuming
+    drawn_rain = rain is None and avg is not None
+    if drawn_rain:
+        # the series of a resumed run carries on, steps past its end are drawn from the restored rng
+        depth = resume['series'].get('rain', np.zeros(0)) if resume is not None else np.zeros(0)
+        # whole hours, so a resumed run that is extended gets the rain of an uninterrupted one
+        drawn = -(-max(iter - len(depth), 0) // HOUR) * HOUR
+        if trials == 1:
+            depth = np.concatenate((depth, poisson_rain(drawn, avg, rng)))
+        else:
+            depth = np.concatenate((depth.reshape(-1, trials),
+                                    np.stack([poisson_rain(drawn, avg, r) for r in rngs], axis = 1)))
+        rain = Rainfall(depth)
 
     plot = kwargs.get('plot', False)
+    interval = kwargs.get('interval', 10)
+    # a SnapshotSink (src.snapshots) gets the water layer at step 0, every interval steps
+    # and after the last (or converged) step
+    sink = kwargs.get('sink')
 
     if plot:
-        interval = kwargs.get('interval', 10)
+        # plotting_utils imports this module, so it is only loaded once a run plots
+        import matplotlib.pyplot as plt
+        from src.plotting_utils import plot_water, WaterView
+
         frames = []
         fig = plt.figure()
         ax = fig.add_subplot(111, projection='3d')
-        frames.append([plot_water(basin[...,0],basin[...,1], ax = ax)])
+        # plot_mode = 'surface' draws the terrain once and a water mesh per frame instead of bars
+        if kwargs.get('plot_mode', 'bars') == 'surface':
+            view = WaterView(basin[...,0], ax = ax)
+            draw = lambda: view.update(basin[...,1], new = True)
+        else:
+            draw = lambda: plot_water(basin[...,0],basin[...,1], ax = ax)
+        frames.append([draw()])
 
     else:
         frames  = None
         fig = None
 
-    start = time.time()
-
-    N = basin[...,0].shape[0]
-    for it in tqdm.tqdm(range(iter)):
-        water_heights = basin[...,0] + basin[...,1]
-
-        # make a copy of basin
-        basin_copy = basin[...,1].copy()
-
-        for i in range(N):
-            for j in range(N):
-                central_height = water_heights[i,j]
-                
-                # store downstream neighbors
-                v = []
-                # calculate height difference between central cell and neighbors
-                for dx in range(-1,2):
-                    for dy in range(-1,2):
-                        # if neighbor is in bounds
-                        if 0 <= i+dx < N and 0 <= j+dy < N:
-                            neighbor_height = water_heights[i+dx,j+dy]
-                            # if neighbor is not no_data
-                            if neighbor_height > 0:
-                                # calculate difference
-                                diff = central_height - neighbor_height
-                                # exclude self
-                                if diff - tau > 0:
-                                    v.append(((i + dx, j + dy), diff * area))
-                    
-                # sum up differences to find total available volume
-                v_tot_avail = np.sum([x[1] for x in v])
-
-                # minimum in v
-                try: 
-                    v_min = min([x[1] for x in v])
-                except: 
-                    v_min = 0.01
-                try:
-                    v_max = max([x[1] for x in v])
-                except:
-                    # possibly np.inf
-                    v_max = 1e4
-                
-                # calculate weight for each downstream neighbor
-                weights = [(x[0], x[1]/(v_tot_avail + v_min)) for x in v]
-                min_weight = v_min/(v_tot_avail + v_min)
-                weights.append(((i,j),  min_weight))
-        
-                w_max = max([x[1] for x in weights])
-
-                # do weights sum to 1
-                #assert round(np.array([x[1] for x in weights]).sum()) == 1
-
-                
-
-                central_depth = basin[i,j,1]
+    # with workers > 1 the grid is split into strips of rows, one process each
+    workers = kwargs.get('workers', 1)
+    if workers > 1 and (plot or sink or adaptive or tol is not None or rain is not None):
+        raise ValueError('plot, sink, adaptive, tol and rain are not supported with workers > 1')
+    if workers > 1 and (checkpoint or resume is not None or flood_maps or probes or len(regions)):
+        raise ValueError('checkpoint, resume_from, flood_maps, probes and regions are not supported with workers > 1')
+    if trials > 1 and (engine != 'numpy' or plot or sink or workers > 1):
+        raise ValueError("trials > 1 needs engine = 'numpy' and does not support plot, sink or workers > 1")
+
+    # engines that keep data between iterations (e.g. the active set) store it here
+    state = {}
+    # a profiling.Profiler times every phase of each iteration (the engine's phases are nested in
+    # 'step') and collects the engine's counters, see Profiler.table and write_chrome_trace
+    profile = kwargs.get('profile')
+    if profile is not None:
+        state['profile'] = profile
+    # an init_topology index can be shared between runs on the same DEM
+    if 'topology' in kwargs:
+        state['topology'] = kwargs['topology']
+    # or be read from a grid_cache.GridCache
+    if kwargs.get('cache') is not None:
+        state['cache'] = kwargs['cache']
 
-                manning = 1/n * central_depth**(2/3) * np.sqrt(v_max / dist)
-                # maximum permissible velocity
-                vm = min(np.sqrt(central_depth*g), manning)
+    start = time.time()
 
-                inter_cell_max = vm * central_depth * t * edgel
+    # grids do not have to be square
+    rows, cols = basin[...,0].shape
+    N = rows
 
-                v_incell = central_depth * area
+    steps = iter
+    converged = False
 
-                ic_vol = min(v_incell, inter_cell_max/w_max, v_min)
+    if workers > 1:
+        # every strip uses the numpy update rule
+        from src.decompose import run_blocks
+        with timed(state, 'blocks'):
+            tot_mass, cell_water, frac_flooded = run_blocks(
+                basin, workers, iter, target_cell, tau, t, n, g = g, edgel = edgel, thresholds = thresholds)
 
-                # update water column in neighbors
-                for x in weights:
-                    ii,jj = x[0]
-                    if i == ii and j == jj:
-                        # update water column in central cell
-                        basin_copy[ii,jj] -= ic_vol/area
-                    # update water column in neighbors
-                    basin_copy[ii,jj] += ic_vol * x[1] / area
-
-        # merge copy into basin
-        basin[...,1] = basin_copy
-
-
-        ##### For Analysis #####
-        if plot:
-            if it % interval == 0:
-                frames.append([plot_water(basin[...,0],basin[...,1], ax = ax)])
-        
-        tot_mass[it]  = basin[...,1].sum()
-        cell_water[it] = basin[target_cell[0], target_cell[1], 1]
+    else:
+        # sqrt(g h) of the deepest cell bounds the velocity before the first step
+        dt = courant_step(np.sqrt(g * max(basin[...,1].max(), 0)), t, cfl, edgel) if adaptive else t
+        elapsed = 0
+        if resume is not None:
+            dt, elapsed = resume['dt'], resume['elapsed']
+        elif sink:
+            sink.write(0, basin[...,1], time = elapsed)
+
+        # the trials' water layers are a copy, the DEM stays shared
+        water = basin[...,1] if trials == 1 else np.repeat(basin[...,1][None], trials, axis = 0)
+        if trials > 1 and resume is not None:
+            water = resume['water'].copy()
+
+        for it in progress_bar(range(first, iter), kwargs.get('progress', True)):
+            if profile is not None:
+                profile.start_iteration(it)
+
+            if rain is not None and it < len(rain) and rain.falls(it):
+                with timed(state, 'rain'):
+                    water += rain[it]
+                # the rained on cells changed, so the frontier engine starts again from all wet cells
+                state.pop('active', None)
+
+            with timed(state, 'step'):
+                water = step(basin[...,0], water, tau, dt, n, g = g, edgel = edgel, state = state)
+                if trials == 1:
+                    # merge updated water column into basin
+                    basin[...,1] = water
+                    water = basin[...,1]
+            elapsed += dt
+            sim_time[it] = elapsed
+
+
+            ##### For Analysis #####
+            if plot:
+                if it % interval == 0:
+                    with timed(state, 'plot'):
+                        frames.append([draw()])
+            with timed(state, 'bookkeeping'):
+                tot_mass[it]  = water.sum(axis = (-2, -1))
+                cell_water[it] = water[..., target_cell[0], target_cell[1]]
+                frac_flooded[it] = np.transpose([np.mean(water > thresh, axis = (-2, -1)) for thresh in thresholds])
+                metrics.update(it, water, elapsed, dt)
+
+            if tol is not None and state['max_moved'] < tol:
+                steps = it + 1
+                converged = True
+
+            if sink and ((it + 1) % interval == 0 or it + 1 == iter or converged):
+                with timed(state, 'sink'):
+                    sink.write(it + 1, basin[...,1], time = elapsed)
+
+            if adaptive:
+                dt = courant_step(state['max_velocity'], t, cfl, edgel)
+
+            if checkpoint and (converged or (it + 1) % checkpoint_interval == 0 or it + 1 == iter):
+                with timed(state, 'checkpoint'):
+                    save_checkpoint(
+                        checkpoint, basin, iteration = it + 1,
+                        series = {
+                            'tot_mass': tot_mass[:it + 1], 'cell_water': cell_water[:it + 1],
+                            'frac_flooded': frac_flooded[:it + 1], 'sim_time': sim_time[:it + 1],
+                            **({'rain': rain.depth} if drawn_rain else {}),
+                            **{f'metric_{key}': value for key, value in metrics.arrays(it + 1).items()}},
+                        rng = rng if trials == 1 else rngs,
+                        params = params,
+                        water = None if trials == 1 else water,
+                        dt = dt, elapsed = elapsed)
+
+            if converged:
+                break
+
+        # drop the iterations that were not needed
+        tot_mass, cell_water, sim_time = tot_mass[:steps], cell_water[:steps], sim_time[:steps]
+        frac_flooded = frac_flooded[:steps]
+
+        if trials > 1:
+            # trials first: tot_mass[trial] is the series of one trial
+            tot_mass, cell_water = tot_mass.T, cell_water.T
+            frac_flooded = np.moveaxis(frac_flooded, 1, 0)
 
     stop = time.time()
     duration = stop - start
-    # write results to new line in results.txt
-    with open('perf_results.txt', 'a') as f:
-        f.write((f'{duration},{N},{iter},{tot_mass[0]},{tau},{t},{area} \n'))
 
     return {
         'tot_mass': tot_mass,
         'cell_water': cell_water,
         'duration': duration,
         'N': N,
+        'shape': (rows, cols),
         'iter': iter,
+        'steps': steps,
+        'sim_time': sim_time,
+        'converged': converged,
         'tau': tau,
         't': t,
         'area': area,
+        'engine': engine,
+        'frac_flooded': frac_flooded,
+        'thresholds': thresholds,
+        'trials': trials,
+        'final_levels': np.array(basin[...,1] if trials == 1 else water),
+        'profile': profile,
+        # probes, regions and, with flood_maps, max_depth, first_flooded and inundation
+        **metrics.results(steps),
         'frames': frames,
         'fig': fig
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,325 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from src.CA import ENGINES, create_basin, init_grid, resize_array, run_sim
+from src.forcing import Rainfall, poisson_rain
+
+
+############################ Benchmarks ########################################################
+
+# Every engine is run on the same fixed scenarios and compared with the reference loop engine.
+# Results are written as JSON together with the machine and commit they were measured on, and two
+# result files can be compared to catch an optimization that is slower or no longer correct.
+# The import time of the simulation core is measured too, in a fresh interpreter.
+#
+#   python -m src.benchmark run --out bench.json
+#   python -m src.benchmark compare base.json bench.json
+
+KERALA = os.path.join(os.path.dirname(__file__), '..', 'media', 'kerala.tif')
+# directory src is imported from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# optional dependencies the simulation core should not import
+HEAVY_MODULES = ['matplotlib', 'scipy', 'tqdm', 'numba']
+
+# largest difference to the loop engine that still counts as the same result
+FIELD_TOL = 1e-6
+# largest relative error of the total volume
+MASS_TOL = 1e-9
+
+def basin_scenario(N):
+    # toy basin with water on the border
+    return create_basin(N)[...,0], {'fill': 1, 'kind': 'border'}, None
+
+def dam_scenario(N = 100):
+    # dry toy basin with a dam across it and rain
+    dem = create_basin(N)[...,0].copy()
+    dem[int(0.55*N):int(0.75*N), int(0.45*N)] = 500
+    return dem, {'fill': 0, 'kind': 'everywhere'}, 1500
+
+def read_dem(path):
+    # DEM from a GeoTIFF, with geotiff like the notebooks or with PIL
+    try:
+        import geotiff
+        return np.array(geotiff.GeoTiff(path).read(), dtype = float)
+    except ImportError:
+        from PIL import Image
+        return np.array(Image.open(path), dtype = float)
+
+def kerala_scenario(N = 100):
+    # the study area of the notebooks resampled to N x N, dry with rain
+    dem = read_dem(KERALA)
+    # fit to mountains, no_data and sea are 0
+    dem = dem[400:, 600:]
+    dem[dem < 0] = 0
+    return resize_array(dem, N, N), {'fill': 0, 'kind': 'everywhere'}, 1500
+
+def scenarios(sizes = (32, 64, 128)):
+    # name -> function returning (DEM, init_grid options, average monthly rain (mm) or None)
+    found = {f'basin_{N}': (lambda N = N: basin_scenario(N)) for N in sizes}
+    found['dam_100'] = dam_scenario
+    found['kerala_100'] = kerala_scenario
+    return found
+
+def metadata():
+    # where and on what the benchmark ran
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], capture_output = True, text = True,
+                                  cwd = os.path.dirname(__file__)).stdout.strip() or None
+        except OSError:
+            return None
+
+    return {
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(git('status', '--porcelain', '--', '.')),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+    }
+
+def import_time(module = 'src.CA', repeat = 5):
+    # Seconds to import module in a fresh interpreter (best of repeat, numpy included)
+    # and the heavy optional dependencies it pulled in
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            f'import {module}\n'
+            'print(time.perf_counter() - start)\n'
+            f'print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))')
+
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True,
+                             cwd = ROOT, check = True).stdout.split('\n')
+        times.append(float(out[0]))
+
+    return {'module': module, 'import_s': min(times), 'loaded': [m for m in out[1].split(',') if m]}
+
+def run_engine(basin, engine, iter, rain):
+    # One timed run, returns the run_sim results
+    return run_sim(basin.copy(), engine = engine, iter = iter, rain = rain, progress = False)
+
+def peak_memory(basin, engine, iter, rain):
+    # Peak memory (bytes) allocated while running, traced on a separate short run
+    # as tracing slows down the loop engine
+    tracemalloc.start()
+    try:
+        run_engine(basin, engine, iter, rain)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def check_sim_time(engine, N = 16, iter = 20):
+    # run_sim(adaptive = True) has to report the simulated time as floats that grow every step,
+    # an integer array (t = 1) truncates the adaptive steps
+    basin = init_grid(create_basin(N)[...,0], fill = 1, kind = 'border')
+    sim_time = run_sim(basin, engine = engine, iter = iter, adaptive = True, progress = False)['sim_time']
+
+    is_float = bool(np.issubdtype(sim_time.dtype, np.floating))
+    increasing = bool(np.all(np.diff(sim_time) > 0)) and bool(sim_time[0] > 0)
+    return {'engine': engine, 'float': is_float, 'increasing': increasing, 'ok': is_float and increasing}
+
+def benchmark(**kwargs):
+    # Run every engine on every scenario, returns the results as a JSON serialisable dict
+    iter = kwargs.get('iter', 30)
+    engines = kwargs.get('engines', list(ENGINES))
+    mem_iter = kwargs.get('mem_iter', 3)
+    log = kwargs.get('log', print)
+
+    imports = [import_time(module) for module in kwargs.get('imports', ['src.CA'])]
+    for entry in imports:
+        log(f"import {entry['module']}: {entry['import_s']:.3f} s, loads {', '.join(entry['loaded']) or 'no heavy modules'}")
+
+    sim_times = []
+    for engine in engines:
+        try:
+            sim_times.append(check_sim_time(engine))
+        except ImportError as e:
+            sim_times.append({'engine': engine, 'skipped': str(e)})
+            continue
+        if not sim_times[-1]['ok']:
+            log(f"{engine}: adaptive sim_time is not a strictly increasing float series")
+
+    results = []
+    for name, make in scenarios(kwargs.get('sizes', (32, 64, 128))).items():
+        if kwargs.get('scenarios') and name not in kwargs['scenarios']:
+            continue
+
+        try:
+            dem, options, avg = make()
+        except (ImportError, OSError) as e:
+            log(f'{name}: skipped ({e})')
+            results.append({'scenario': name, 'skipped': str(e)})
+            continue
+
+        # preprocessing of the DEM alone, building it (e.g. create_basin's loop) is not timed
+        start = time.perf_counter()
+        basin = init_grid(dem, **options)
+        prep = time.perf_counter() - start
+
+        rows, cols = basin[...,0].shape
+        # the same rain for every engine
+        rain = None if avg is None else Rainfall(poisson_rain(iter, avg, np.random.default_rng(0)))
+        added = 0 if rain is None else rain.depth.sum() * rows * cols
+        initial = basin[...,1].sum()
+
+        reference = run_engine(basin, 'loop', iter, rain)
+        # if no water moved yet (e.g. rain on a dry DEM for a few steps), the engines are still
+        # compared, but only on the rained-on initial state, so the run warns about it
+        no_flow = basin[...,1].copy()
+        for it in range(min(iter, len(rain) if rain is not None else 0)):
+            if rain.falls(it):
+                no_flow += rain[it]
+        checked = bool(np.abs(reference['final_levels'] - no_flow).max() > FIELD_TOL)
+        for engine in engines:
+            entry = {'scenario': name, 'shape': [rows, cols], 'engine': engine, 'iter': iter, 'prep_s': prep}
+            try:
+                # first call, includes compiling and any lazy setup
+                start = time.perf_counter()
+                run_engine(basin, engine, 1, rain)
+                entry['warmup_s'] = time.perf_counter() - start
+
+                r = reference if engine == 'loop' else run_engine(basin, engine, iter, rain)
+            except ImportError as e:
+                log(f'{name} {engine}: skipped ({e})')
+                entry['skipped'] = str(e)
+                results.append(entry)
+                continue
+
+            expected = initial + added
+            entry.update({
+                'duration_s': r['duration'],
+                'cell_updates_per_s': rows * cols * r['steps'] / r['duration'],
+                'peak_memory_bytes': peak_memory(basin, engine, mem_iter, rain),
+                'mass_error': float(abs(r['tot_mass'][-1] - expected) / max(expected, 1)),
+                'field_error': float(np.abs(r['final_levels'] - reference['final_levels']).max()),
+                'series_error': float(np.abs(r['tot_mass'] - reference['tot_mass']).max()),
+            })
+            entry['ok'] = entry['field_error'] <= FIELD_TOL and entry['mass_error'] <= MASS_TOL
+            entry['checked'] = checked
+            log(f"{name} {engine}: {entry['cell_updates_per_s']:.3g} cells/s, "
+                f"field error {entry['field_error']:.2g}, mass error {entry['mass_error']:.2g}"
+                f"{'' if checked else ' (no water moved yet)'}")
+            results.append(entry)
+
+    return {'meta': metadata(), 'params': {'iter': iter, 'mem_iter': mem_iter}, 'imports': imports,
+            'sim_time': sim_times, 'results': results}
+
+def table(results):
+    # Text table of one benchmark
+    lines = [f"{'scenario':<12} {'engine':<9} {'cells/s':>10} {'peak MB':>8} {'prep s':>7} "
+             f"{'field err':>10} {'mass err':>9}  ok"]
+    for r in results['results']:
+        if 'skipped' in r:
+            lines.append(f"{r['scenario']:<12} {r.get('engine', ''):<9} skipped: {r['skipped']}")
+            continue
+        lines.append(
+            f"{r['scenario']:<12} {r['engine']:<9} {r['cell_updates_per_s']:>10.3g} "
+            f"{r['peak_memory_bytes'] / 2**20:>8.2f} {r['prep_s']:>7.3f} "
+            f"{r['field_error']:>10.2g} {r['mass_error']:>9.2g}  "
+            f"{'yes' if r['ok'] else 'NO'}{'' if r.get('checked', True) else ' (no flow)'}")
+
+    for r in results.get('imports', []):
+        lines.append(f"import {r['module']:<12} {r['import_s']:>8.3f} s  loads {', '.join(r['loaded']) or '-'}")
+    for r in results.get('sim_time', []):
+        if 'skipped' not in r:
+            lines.append(f"adaptive sim_time {r['engine']:<9} {'ok' if r['ok'] else 'NOT float and increasing'}")
+    return '\n'.join(lines)
+
+def compare(base, new, slower = 0.9):
+    # Report of new against base (benchmark results): speed and memory ratios per scenario and
+    # engine, flagging runs that got slower than slower * base or stopped matching the loop engine
+    before = {(r['scenario'], r.get('engine')): r for r in base['results'] if 'skipped' not in r}
+
+    lines = [f"base {base['meta']['commit']} ({base['meta']['platform']})",
+             f"new  {new['meta']['commit']} ({new['meta']['platform']})",
+             f"{'scenario':<12} {'engine':<9} {'speed':>7} {'memory':>7}  notes"]
+    regressions = 0
+    for r in new['results']:
+        old = before.get((r['scenario'], r.get('engine')))
+        if 'skipped' in r or old is None:
+            continue
+
+        speed = r['cell_updates_per_s'] / old['cell_updates_per_s']
+        memory = r['peak_memory_bytes'] / max(old['peak_memory_bytes'], 1)
+        notes = []
+        if speed < slower:
+            notes.append('slower')
+        if not r['ok']:
+            notes.append('differs from loop')
+        regressions += bool(notes)
+        if not r.get('checked', True):
+            notes.append('no flow')
+        lines.append(f"{r['scenario']:<12} {r['engine']:<9} {speed:>6.2f}x {memory:>6.2f}x  {', '.join(notes)}")
+
+    # import time, older results have none
+    before = {r['module']: r for r in base.get('imports', [])}
+    for r in new.get('imports', []):
+        old = before.get(r['module'])
+        if old is None:
+            continue
+        speed = old['import_s'] / r['import_s']
+        notes = []
+        if speed < slower:
+            notes.append('slower')
+        if set(r['loaded']) - set(old['loaded']):
+            notes.append(f"now loads {', '.join(sorted(set(r['loaded']) - set(old['loaded'])))}")
+        regressions += bool(notes)
+        lines.append(f"import {r['module']:<15} {speed:>6.2f}x {'':>7}  {', '.join(notes)}")
+
+    lines.append(f'{regressions} regressions')
+    return '\n'.join(lines), regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark and check the CA engines')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    run = commands.add_parser('run', help = 'benchmark every engine')
+    run.add_argument('--out', default = 'bench.json')
+    run.add_argument('--iter', type = int, default = 30)
+    run.add_argument('--sizes', type = int, nargs = '+', default = [32, 64, 128])
+    run.add_argument('--engines', nargs = '+', default = list(ENGINES))
+    run.add_argument('--scenarios', nargs = '+')
+    run.add_argument('--imports', nargs = '+', default = ['src.CA'], help = 'modules to time the import of')
+
+    comp = commands.add_parser('compare', help = 'compare two benchmark files')
+    comp.add_argument('base')
+    comp.add_argument('new')
+    comp.add_argument('--slower', type = float, default = 0.9)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        results = benchmark(iter = args.iter, sizes = args.sizes, engines = args.engines, scenarios = args.scenarios,
+                            imports = args.imports)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent = 1)
+        print(table(results))
+        unchecked = sorted({r['scenario'] for r in results['results'] if r.get('checked') is False})
+        if unchecked:
+            print(f"WARNING: no water moved in {', '.join(unchecked)} within --iter {args.iter} steps, "
+                  'their engines were only compared on the initial state plus rain. Use a larger --iter',
+                  file = sys.stderr)
+        # a failed equivalence or sim_time check fails the run
+        return 0 if all(r.get('ok', True) for r in results['results'] + results['sim_time']) else 1
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    report, regressions = compare(base, new, args.slower)
+    print(report)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
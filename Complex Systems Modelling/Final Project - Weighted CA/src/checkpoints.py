@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from src.grid import Grid
+
+
+############################ Checkpoints #######################################################
+
+# A checkpoint is one compressed .npz file with the grid layers, the series recorded so far and a
+# 'meta' entry: JSON with the iteration, parameters, random generator state and a sha256 of every
+# array. Files are written next to the target and renamed over it, so a crash while saving
+# leaves the previous checkpoint intact.
+
+def checksum(array):
+    array = np.ascontiguousarray(array)
+    h = hashlib.sha256(f'{array.shape}{array.dtype.str}'.encode())
+    if array.size:
+        h.update(memoryview(array).cast('B'))
+
+    return h.hexdigest()
+
+def to_json(value):
+    # numpy scalars and arrays in params
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f'{type(value).__name__} can not be stored in a checkpoint')
+
+def rng_state(rng):
+    # state of a numpy Generator, or of each in a list of them
+    if isinstance(rng, (list, tuple)):
+        return [rng_state(r) for r in rng]
+    if not isinstance(rng, np.random.Generator):
+        raise TypeError('Only numpy Generators (np.random.default_rng) can be stored in a checkpoint')
+    return rng.bit_generator.state
+
+def restore_rng(state):
+    if isinstance(state, list):
+        return [restore_rng(s) for s in state]
+
+    bit_generator = getattr(np.random, state['bit_generator'])()
+    bit_generator.state = state
+    return np.random.Generator(bit_generator)
+
+def save_checkpoint(path, basin, iteration = 0, series = None, rng = None, params = None, water = None, **extra):
+    # Save basin (interleaved array or Grid) after `iteration` steps.
+    # series: arrays recorded so far (tot_mass, cell_water, ...), rng: a Generator or a list of them,
+    # params: the run's parameters, water: water layers kept outside basin (run_sim trials),
+    # extra: any other JSON values (elapsed time, step size, ...)
+    layers = basin.layers if isinstance(basin, Grid) else [basin[..., k] for k in range(basin.shape[-1])]
+
+    arrays = {f'layer_{k}': np.asarray(layer) for k, layer in enumerate(layers)}
+    arrays.update({f'series_{name}': np.asarray(values) for name, values in (series or {}).items()})
+    if water is not None:
+        arrays['water'] = np.asarray(water)
+
+    meta = {
+        'layout': 'layers' if isinstance(basin, Grid) else 'interleaved',
+        'layers': len(layers),
+        'iteration': iteration,
+        'series': list(series or {}),
+        'rng': None if rng is None else rng_state(rng),
+        'params': params or {},
+        'extra': extra,
+        'checksums': {key: checksum(array) for key, array in arrays.items()},
+    }
+
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, meta = np.array(json.dumps(meta, default = to_json)), **arrays)
+    os.replace(tmp, path)
+
+def load_checkpoint(path):
+    # Read a checkpoint written by save_checkpoint, raises ValueError if an array does not match its checksum
+    with np.load(path) as data:
+        meta = json.loads(str(data['meta']))
+        arrays = {key: data[key] for key in meta['checksums']}
+
+    for key, array in arrays.items():
+        if checksum(array) != meta['checksums'][key]:
+            raise ValueError(f'Checkpoint {path} is corrupt: {key} does not match its checksum')
+
+    layers = [arrays[f'layer_{k}'] for k in range(meta['layers'])]
+    basin = Grid(layers) if meta['layout'] == 'layers' else np.stack(layers, axis = -1)
+
+    return {
+        'basin': basin,
+        'iteration': meta['iteration'],
+        'series': {name: arrays[f'series_{name}'] for name in meta['series']},
+        'rng': None if meta['rng'] is None else restore_rng(meta['rng']),
+        'params': meta['params'],
+        'water': arrays.get('water'),
+        **meta['extra'],
+    }
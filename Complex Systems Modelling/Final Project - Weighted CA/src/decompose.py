@@ -0,0 +1,143 @@
+import numpy as np
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from src.CA import cell_outflows, gather_inflows
+
+
+############################ Domain decomposition ##############################################
+
+# The grid is split into strips of rows, each advanced by its own process.
+# All layers live in shared memory, so a strip's one-cell halo is read straight from its
+# neighbours' rows once every process has reached the same point of the step (barrier).
+
+def spawn_context():
+    # Every worker process (strips here, ensemble trials) is spawned, not forked: a fork of a
+    # process that already ran numba's threaded engine inherits its thread pool and hangs at exit.
+    # Spawned processes import the calling script again, so scripts that start workers need an
+    # if __name__ == '__main__': guard
+    return mp.get_context('spawn')
+
+def spawn_pool(workers, **kwargs):
+    # ProcessPoolExecutor of workers spawned processes, kwargs as for ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers = workers, mp_context = spawn_context(), **kwargs)
+
+def split_rows(rows, blocks):
+    # first and last+1 row of each strip
+    edges = np.linspace(0, rows, blocks + 1).astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+def create_shared(shape):
+    # zeroed float array in a new shared memory block
+    shm = shared_memory.SharedMemory(create = True, size = max(int(np.prod(shape)), 1) * 8)
+    array = np.ndarray(shape, dtype = float, buffer = shm.buf)
+    array[...] = 0
+
+    return shm, array
+
+def attach_shared(layout):
+    # layout maps a name to (shared memory name, shape)
+    shms, arrays = {}, {}
+    for key, (name, shape) in layout.items():
+        shms[key] = shared_memory.SharedMemory(name = name)
+        arrays[key] = np.ndarray(shape, dtype = float, buffer = shms[key].buf)
+
+    return shms, arrays
+
+def advance_block(layout, block, first, last, barrier, iter, target_cell, thresholds, params):
+    # Worker: advance rows first:last of the shared grid for iter steps
+    shms, arrays = attach_shared(layout)
+    dem, water, share = arrays['dem'], arrays['water'], arrays['share']
+
+    rows = dem.shape[0]
+    # rows this strip reads: its own rows plus a one-cell halo
+    top, bottom = max(first - 1, 0), min(last + 1, rows)
+    own = slice(first - top, last - top)
+    owns_target = first <= target_cell[0] < last
+
+    try:
+        for it in range(iter):
+            current, new = water[it % 2], water[(it + 1) % 2]
+
+            water_heights = dem[top:bottom] + current[top:bottom]
+            _, block_share, kept = cell_outflows(water_heights, current[top:bottom], **params)
+            share[first:last] = block_share[own]
+
+            # neighbouring strips have written the share of our halo rows
+            barrier.wait()
+
+            new[first:last] = gather_inflows(
+                water_heights, share[top:bottom], kept, params['tau'])[own]
+
+            # per-strip part of the step's totals
+            arrays['mass'][it, block] = new[first:last].sum()
+            arrays['flooded'][it, block] = [np.sum(new[first:last] > thresh) for thresh in thresholds]
+            if owns_target:
+                arrays['cell_water'][it] = new[target_cell[0], target_cell[1]]
+
+            # every strip is done with this step before the buffers swap
+            barrier.wait()
+
+    except Exception:
+        # release the other strips instead of leaving them waiting at the barrier
+        barrier.abort()
+        raise
+
+def run_blocks(basin, workers, iter, target_cell, tau, t, n, g = 10, edgel = 1, thresholds = ()):
+    # Advance basin[...,1] in place with one process per strip of rows
+    # returns the tot_mass, cell_water and frac_flooded series
+    rows, cols = basin[...,0].shape
+    workers = max(1, min(workers, rows))
+
+    shapes = {
+        'dem': (rows, cols),
+        # current and next water layer
+        'water': (2, rows, cols),
+        'share': (rows, cols),
+        'mass': (iter, workers),
+        'flooded': (iter, workers, len(thresholds)),
+        'cell_water': (iter,),
+    }
+    shms, arrays = {}, {}
+    for key, shape in shapes.items():
+        shms[key], arrays[key] = create_shared(shape)
+
+    try:
+        arrays['dem'][...] = basin[...,0]
+        arrays['water'][0] = basin[...,1]
+
+        layout = {key: (shms[key].name, shape) for key, shape in shapes.items()}
+        params = {'tau': tau, 't': t, 'n': n, 'g': g, 'edgel': edgel}
+
+        ctx = spawn_context()
+        barrier = ctx.Barrier(workers)
+        procs = [
+            ctx.Process(
+                target = advance_block,
+                args = (layout, block, first, last, barrier, iter, target_cell, thresholds, params))
+            for block, (first, last) in enumerate(split_rows(rows, workers))]
+
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+
+        failed = [p.exitcode for p in procs if p.exitcode != 0]
+        if failed:
+            raise RuntimeError(f'{len(failed)} of {workers} block workers failed, exit codes {failed}')
+
+        basin[...,1] = arrays['water'][iter % 2]
+        # reduce the per-strip sums of each step
+        tot_mass = arrays['mass'].sum(axis = 1)
+        cell_water = arrays['cell_water'].copy()
+        frac_flooded = arrays['flooded'].sum(axis = 1) / (rows * cols)
+
+    finally:
+        # views have to go before the memory is released
+        arrays.clear()
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+
+    return tot_mass, cell_water, frac_flooded
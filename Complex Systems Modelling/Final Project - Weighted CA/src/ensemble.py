@@ -0,0 +1,99 @@
+import os
+from concurrent.futures import as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from src.CA import run_sim, init_topology
+from src.decompose import spawn_pool
+from src.grid import Grid
+
+
+############################ Monte Carlo ensembles #############################################
+
+# Trials of the same DEM only differ in their water layer and random stream, so the DEM and the
+# static layers (slope, directions, topology index) are put in shared memory once and every
+# worker process reads them from there instead of getting its own copy per trial.
+
+# arrays shared with the workers, filled in by attach_static in each worker
+STATIC = {}
+
+def share_array(array):
+    # copy an array into a new shared memory block, returns the block and its layout
+    shm = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype = array.dtype, buffer = shm.buf)[...] = array
+
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def attach_static(layout):
+    # Worker initializer: map every shared array read-only
+    for key, (name, shape, dtype) in layout.items():
+        shm = shared_memory.SharedMemory(name = name)
+        array = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+        array.flags.writeable = False
+        # keep the block open as long as the worker lives
+        STATIC[key] = (shm, array)
+
+def static(key):
+    return STATIC[key][1]
+
+def run_trial(trial, seed_seq, kwargs):
+    # One run_sim on the shared static layers with its own water layer and random stream
+    basin = Grid([static('dem'), static('water').copy(), static('slope'), static('directions')])
+
+    # topology rows are shared, the lazily updated parts are per trial
+    topology = {
+        'offsets': static('offsets'),
+        'nbrs': static('nbrs'),
+        'headroom': static('headroom').copy(),
+        'spilled': np.zeros(len(static('headroom')), dtype = bool),
+    }
+
+    # no progress bars unless asked for, the trial's own stream replaces any rng in kwargs
+    results = run_sim(basin, **{
+        'progress': False,
+        **kwargs,
+        'rng': np.random.default_rng(seed_seq),
+        'topology': topology})
+
+    return trial, {
+        'trial': trial,
+        'tot_mass': results['tot_mass'],
+        'cell_water': results['cell_water'],
+        'frac_flooded': results['frac_flooded'],
+        'thresholds': results['thresholds'],
+        'final_levels': results['final_levels'],
+        'duration': results['duration'],
+    }
+
+def run_ensemble(basin, trials = 50, seed = None, workers = None, **kwargs):
+    # Run trials of run_sim(basin, **kwargs) on a process pool.
+    # Each trial gets its own random stream spawned from seed, so an ensemble is reproducible
+    # whatever the number of workers. Yields (trial, summary) as trials finish
+    workers = workers or os.cpu_count()
+
+    static_layers = {
+        'dem': np.ascontiguousarray(basin[...,0]),
+        'water': np.ascontiguousarray(basin[...,1]),
+        'slope': np.ascontiguousarray(basin[...,2]),
+        'directions': np.ascontiguousarray(basin[...,3]),
+    }
+    topology = init_topology(static_layers['dem'])
+    static_layers.update({key: topology[key] for key in ['offsets', 'nbrs', 'headroom']})
+
+    shms, layout = [], {}
+    try:
+        for key, array in static_layers.items():
+            shm, layout[key] = share_array(array)
+            shms.append(shm)
+
+        streams = np.random.SeedSequence(seed).spawn(trials)
+        with spawn_pool(workers, initializer = attach_static, initargs = (layout,)) as pool:
+            futures = [pool.submit(run_trial, trial, streams[trial], kwargs) for trial in range(trials)]
+            for future in as_completed(futures):
+                yield future.result()
+
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,130 @@
+import numpy as np
+
+
+############################ Rainfall forcing ##################################################
+
+# Rain for a whole run is generated up front. A Rainfall gives the depth (m) to add to the water
+# layer in each step, either depth[it] * mask for one series over a spatial mask, or field[it]
+# for gridded (radar like) rain, so run_sim adds it with one array op per step.
+
+class Rainfall:
+    # depth: (iter,) series in m, or (iter, trials) with one column per trial of run_sim(trials = ...)
+    # mask: (rows, cols) weights of the series in each cell (circle_mask, polygon_mask), None for everywhere
+    # field: (iter, rows, cols) rain per step and cell, e.g. from radar_field, instead of depth and mask
+    def __init__(self, depth = None, mask = None, field = None) -> None:
+        if (depth is None) == (field is None):
+            raise ValueError('Give either a depth series or a rain field')
+        self.depth = None if depth is None else np.asarray(depth, dtype = float)
+        self.mask = None if mask is None else np.asarray(mask, dtype = float)
+        self.field = field
+
+    def __len__(self):
+        return len(self.depth if self.field is None else self.field)
+
+    def __getitem__(self, it):
+        # rain of step it, a scalar or an array that broadcasts against the water layer(s)
+        if self.field is not None:
+            return self.field[it]
+
+        depth = self.depth[it]
+        if np.ndim(depth):
+            # one value per trial
+            depth = depth[:, None, None]
+        return depth if self.mask is None else depth * self.mask
+
+    def falls(self, it):
+        # whether any rain falls in step it
+        if self.field is not None:
+            return bool(np.any(self.field[it] > 0))
+        return bool(np.any(self.depth[it] > 0)) and (self.mask is None or bool(np.any(self.mask > 0)))
+
+def as_rainfall(rain):
+    # Rainfall from an (iter,) / (iter, trials) depth series or an (iter, rows, cols) field
+    if rain is None or isinstance(rain, Rainfall):
+        return rain
+    rain = np.asarray(rain, dtype = float)
+    return Rainfall(field = rain) if rain.ndim == 3 else Rainfall(rain)
+
+# steps (minutes) drawn together by poisson_rain
+HOUR = 60
+
+def poisson_rain(iter, avg = 700, rng = None):
+    # Rainfall (m) of iter one minute steps for a month with avg (mm) of rain, the model of
+    # CA.get_rain: every minute is Poisson rain for a minute of a random hour (of 12) of a random
+    # day of the month, drawn independently of the other minutes. Picking one of n iid draws has
+    # the distribution of a single draw, so each minute takes three draws, done as array draws.
+    # Minutes are drawn an hour at a time, so the first hours of a longer series are the same as
+    # a shorter one
+    rng = np.random.default_rng() if rng is None else rng
+
+    hours = -(-iter // HOUR)
+    rain = np.empty(hours * HOUR)
+    for h in range(hours):
+        day = rng.poisson(avg / 30, size = HOUR)
+        hour = rng.poisson(day / 12)
+        rain[h * HOUR:(h + 1) * HOUR] = rng.poisson(hour / 60)
+
+    return rain[:iter] / 1000
+
+def circle_mask(shape, center = None, radius = None):
+    # 1 in the cells whose centre lies within radius (cells) of center, 0 elsewhere.
+    # Defaults to the middle of the grid and a quarter of its shortest side
+    rows, cols = shape
+    center = ((rows - 1) / 2, (cols - 1) / 2) if center is None else center
+    radius = min(rows, cols) / 4 if radius is None else radius
+
+    i, j = np.ogrid[:rows, :cols]
+    return ((i - center[0])**2 + (j - center[1])**2 <= radius**2).astype(float)
+
+def polygon_mask(shape, vertices):
+    # 1 in the cells whose centre lies inside the polygon of (row, col) vertices (even-odd rule)
+    rows, cols = shape
+    i, j = np.ogrid[:rows, :cols]
+    inside = np.zeros(shape, dtype = bool)
+
+    vertices = np.asarray(vertices, dtype = float)
+    for (r0, c0), (r1, c1) in zip(vertices, np.roll(vertices, -1, axis = 0)):
+        if r0 == r1:
+            continue
+        # edges that a ray from each cell towards +col crosses
+        crosses = ((r0 > i) != (r1 > i)) & (j < c0 + (i - r0) * (c1 - c0) / (r1 - r0))
+        inside ^= crosses
+
+    return inside.astype(float)
+
+class RadarField:
+    # Gridded rain at a coarser resolution than the DEM, e.g. radar frames (iter, radar rows, radar cols)
+    # in m per step. Each DEM cell takes the value of the radar cell it lies in, looked up per step,
+    # so the full resolution (iter, rows, cols) field is never stored
+    def __init__(self, frames, shape) -> None:
+        self.frames = np.asarray(frames, dtype = float)
+        _, radar_rows, radar_cols = self.frames.shape
+        rows, cols = shape
+        self.index = np.ix_(np.arange(rows) * radar_rows // rows, np.arange(cols) * radar_cols // cols)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, it):
+        return self.frames[it][self.index]
+
+def radar_field(frames, shape):
+    return Rainfall(field = RadarField(frames, shape))
+
+def read_rain_series(path, t = 1, iter = None):
+    # Rain per model step (m) from a csv of (time (s), rain (mm) since the previous row) records.
+    # Rain is spread evenly over each record's interval and summed over steps of t seconds
+    records = np.genfromtxt(path, delimiter = ',')
+    # drop a header and empty lines
+    records = records[~np.isnan(records).any(axis = 1)]
+    times, rain = records[:, 0], records[:, 1] / 1000
+
+    # accumulated rain at the start of the first record and at every record
+    start = times[0] - (times[1] - times[0] if len(times) > 1 else t)
+    times = np.concatenate(([start], times))
+    total = np.concatenate(([0], np.cumsum(rain)))
+
+    iter = int(np.ceil((times[-1] - times[0]) / t)) if iter is None else iter
+    edges = times[0] + t * np.arange(iter + 1)
+
+    return np.diff(np.interp(edges, times, total))
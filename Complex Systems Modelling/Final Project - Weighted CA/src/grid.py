@@ -0,0 +1,72 @@
+import numpy as np
+
+
+############################ Layered grid ######################################################
+
+# Layer order is the same as the interleaved (N, N, layers) grids built by init_grid:
+# 0: DEM, 1: water column, 2: slope, 3: direction bitmask, anything after that is auxiliary
+DEM, WATER, SLOPE, DIRECTIONS = 0, 1, 2, 3
+
+class Grid:
+    # One contiguous array per layer instead of an interleaved (rows, cols, layers) array,
+    # so reading or writing a layer does not stride over the others.
+    # Indexing with the layer last (grid[..., 1], grid[i, j, 0], grid[55:75, 45, 0] = 500)
+    # works like it does on the interleaved array and returns / writes the layer itself.
+    def __init__(self, layers) -> None:
+        self.layers = list(layers)
+
+    @classmethod
+    def from_array(cls, grid, dtype = np.float32, slope_dtype = None):
+        # Split an interleaved grid into layers. DEM, water and auxiliary layers use dtype,
+        # slope uses slope_dtype (e.g. np.float16, defaults to dtype), directions use uint8
+        grid = np.asarray(grid)
+        slope_dtype = dtype if slope_dtype is None else slope_dtype
+
+        layers = []
+        for k in range(grid.shape[-1]):
+            if k == DIRECTIONS:
+                layer_dtype = np.uint8
+            elif k == SLOPE:
+                layer_dtype = slope_dtype
+            else:
+                layer_dtype = dtype
+            layers.append(np.ascontiguousarray(grid[..., k], dtype = layer_dtype))
+
+        return cls(layers)
+
+    @property
+    def shape(self):
+        return self.layers[0].shape + (len(self.layers),)
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def nbytes(self):
+        return sum(layer.nbytes for layer in self.layers)
+
+    def split_key(self, key):
+        # grid[cells..., k] -> (layer k, cells)
+        if not isinstance(key, tuple) or len(key) < 2 or not isinstance(key[-1], (int, np.integer)):
+            raise IndexError('Grid is indexed with the layer last, e.g. grid[..., 1] or grid[i, j, 0]')
+
+        cells = key[:-1]
+        if cells == (Ellipsis,):
+            cells = Ellipsis
+        return self.layers[key[-1]], cells
+
+    def __getitem__(self, key):
+        layer, cells = self.split_key(key)
+        return layer[cells]
+
+    def __setitem__(self, key, value):
+        layer, cells = self.split_key(key)
+        layer[cells] = value
+
+    def __array__(self, dtype = None, copy = None):
+        # interleaved float64 copy for code that needs a plain (rows, cols, layers) array
+        return np.stack(self.layers, axis = -1).astype(dtype or float)
+
+    def copy(self):
+        return Grid([layer.copy() for layer in self.layers])
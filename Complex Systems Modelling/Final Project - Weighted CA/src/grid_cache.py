@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+############################ Preprocessing cache ###############################################
+
+# Layers derived from a DEM (slope, directions, the frontier engine's neighbour index) only depend
+# on the DEM, so they are computed once and kept on disk. An entry is a directory named after the
+# content hash of the DEM and what was derived from it, with one .npy file per array. Entries are
+# opened as read-only memory maps, so a hit costs a hash of the DEM and no copy of the layers.
+# The least recently used entries are deleted once the cache is larger than max_bytes.
+#
+#   cache = GridCache('~/.cache/weighted-ca')
+#   basin = init_grid(dem, fill = 0, kind = 'everywhere', cache = cache)
+#   run_sim(basin, engine = 'frontier', cache = cache)
+
+class GridCache:
+    def __init__(self, path, max_bytes = 2**30) -> None:
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok = True)
+
+    def key(self, dem_key, kind, **options):
+        # entry name for what kind of data is derived with options from the DEM hashed to dem_key
+        description = json.dumps([dem_key, kind, options], sort_keys = True)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def entries(self):
+        # names of the complete entries, unfinished ones are hidden in dot directories
+        return [name for name in os.listdir(self.path)
+                if not name.startswith('.') and os.path.isdir(self.entry_path(name))]
+
+    def get(self, key):
+        # dict of read-only memory mapped arrays, None if key is not cached
+        path = self.entry_path(key)
+        try:
+            arrays = {name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode = 'r')
+                      for name in os.listdir(path) if name.endswith('.npy')}
+        except FileNotFoundError:
+            # missing, or evicted by another process while it was read
+            return None
+
+        # mark as recently used
+        os.utime(path)
+        return arrays
+
+    def put(self, key, arrays):
+        # Store a dict of arrays under key and evict old entries, returns them like get does.
+        # The entry is written next to the cache and renamed into place, so readers (other
+        # processes too) never see a partial entry
+        tmp = tempfile.mkdtemp(prefix = '.tmp-', dir = self.path)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, f'{name}.npy'), np.ascontiguousarray(array))
+            os.replace(tmp, self.entry_path(key))
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors = True)
+            if not os.path.isdir(self.entry_path(key)):
+                raise
+
+        self.evict(keep = key)
+        return self.get(key)
+
+    def entry_size(self, key):
+        path = self.entry_path(key)
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    def size(self):
+        # bytes used by all entries
+        return sum(self.entry_size(key) for key in self.entries())
+
+    def evict(self, keep = None):
+        # Delete least recently used entries until the cache fits in max_bytes, except keep
+        used = []
+        for key in self.entries():
+            try:
+                used.append((os.path.getmtime(self.entry_path(key)), key, self.entry_size(key)))
+            except FileNotFoundError:
+                continue
+
+        total = sum(size for _, _, size in used)
+        for _, key, size in sorted(used):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                # open memory maps stay valid where the OS allows deleting mapped files
+                shutil.rmtree(self.entry_path(key), ignore_errors = True)
+                total -= size
+
+    def clear(self):
+        for key in self.entries():
+            shutil.rmtree(self.entry_path(key), ignore_errors = True)
@@ -0,0 +1,89 @@
+import numpy as np
+
+
+############################ Flood metrics #####################################################
+
+# Statistics that would otherwise need every water layer, accumulated while run_sim steps:
+# per-cell maps (deepest water, when a cell first flooded and for how long it stayed flooded)
+# and depth series of probe cells and regions. Probes and regions are read with one gather of
+# precomputed (row, col) indices per step, the water layer itself is never copied.
+
+def region_cells(region, shape):
+    # (rows, cols) of the cells in a region: a boolean mask or an index such as np.s_[10:20, 5:8]
+    if isinstance(region, np.ndarray) and region.dtype == bool:
+        mask = region
+    else:
+        mask = np.zeros(shape, dtype = bool)
+        mask[region] = True
+    return np.nonzero(mask)
+
+class FloodMetrics:
+    # shape: shape of the water being stepped, (rows, cols) or (trials, rows, cols)
+    # flood_depth: depth (m) above which a cell counts as flooded for first_flooded and inundation
+    # maps: keep the per-cell maps, probes: (row, col) cells, regions: see region_cells
+    def __init__(self, shape, iter, flood_depth = 0.1, maps = False, probes = (), regions = ()) -> None:
+        self.flood_depth = flood_depth
+        self.maps = maps
+        self.batch = shape[:-2]
+
+        if maps:
+            self.max_depth = np.zeros(shape)
+            # simulated time (s) a cell first went over flood_depth, nan if it never did
+            self.first_flooded = np.full(shape, np.nan)
+            # simulated time (s) spent over flood_depth
+            self.inundation = np.zeros(shape)
+
+        # one gather for all probes
+        self.probe_index = tuple(np.array(probes, dtype = int).reshape(-1, 2).T)
+        self.probes = np.zeros((iter,) + self.batch + (len(probes),))
+
+        # cells of every region one after the other, summed per region with reduceat
+        cells = [region_cells(region, shape[-2:]) for region in regions]
+        sizes = np.array([len(rows) for rows, _ in cells], dtype = int)
+        if np.any(sizes == 0):
+            raise ValueError(f'Regions {list(np.flatnonzero(sizes == 0))} have no cells')
+        self.region_index = (np.concatenate([rows for rows, _ in cells]).astype(int) if cells else np.zeros(0, dtype = int),
+                             np.concatenate([cols for _, cols in cells]).astype(int) if cells else np.zeros(0, dtype = int))
+        self.region_starts = np.cumsum(sizes) - sizes
+        self.region_sizes = sizes
+        self.regions = np.zeros((iter,) + self.batch + (len(regions),))
+
+    def update(self, it, water, elapsed, dt):
+        # add the water after step it, at simulated time elapsed, that lasted dt
+        if self.maps:
+            np.maximum(self.max_depth, water, out = self.max_depth)
+            flooded = water > self.flood_depth
+            self.first_flooded[flooded & np.isnan(self.first_flooded)] = elapsed
+            self.inundation += dt * flooded
+
+        if self.probes.shape[-1]:
+            self.probes[it] = water[(...,) + self.probe_index]
+        if self.regions.shape[-1]:
+            depths = water[(...,) + self.region_index]
+            self.regions[it] = np.add.reduceat(depths, self.region_starts, axis = -1) / self.region_sizes
+
+    def arrays(self, steps):
+        # everything accumulated after steps steps, series with the steps first
+        arrays = {'probes': self.probes[:steps], 'regions': self.regions[:steps]}
+        if self.maps:
+            arrays.update({
+                'max_depth': self.max_depth,
+                'first_flooded': self.first_flooded,
+                'inundation': self.inundation})
+        return arrays
+
+    def restore(self, arrays, steps):
+        # continue from arrays() of an earlier run (a checkpoint)
+        self.probes[:steps], self.regions[:steps] = arrays['probes'], arrays['regions']
+        if self.maps:
+            self.max_depth[...] = arrays['max_depth']
+            self.first_flooded[...] = arrays['first_flooded']
+            self.inundation[...] = arrays['inundation']
+
+    def results(self, steps):
+        # arrays() for run_sim's results, with the trials first like its other series
+        arrays = self.arrays(steps)
+        if self.batch:
+            arrays['probes'] = np.moveaxis(arrays['probes'], 1, 0)
+            arrays['regions'] = np.moveaxis(arrays['regions'], 1, 0)
+        return arrays
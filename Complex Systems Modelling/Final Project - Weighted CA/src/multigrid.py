@@ -0,0 +1,106 @@
+import numpy as np
+
+from src.CA import init_grid, resample_weights, resample_dem, resize_array, dem_hash, run_sim
+
+
+############################ Coarse to fine runs ###############################################
+
+# A long run first moves the water on coarse versions of the DEM, where a step covers many fine
+# cells at once, and only the end of the run is done at full resolution.
+# Water is moved between levels as a volume: a coarse cell holds the water of all fine cells
+# in it, so with edgel scaled by the bin size the total volume is the same on every level.
+
+def prolong(layer, shape):
+    # Piecewise constant copy of a coarse layer on a finer grid: every fine cell gets the values
+    # of the coarse cells it lies in, weighted by how much of it each covers
+    rows, cols = layer.shape
+    R_rows = resample_weights(shape[0], rows)
+    R_cols = resample_weights(shape[1], cols)
+
+    # rows of R average a bin, scale them back to the overlap of each fine cell
+    return shape[0] / rows * shape[1] / cols * np.asarray(R_rows.T @ layer @ R_cols)
+
+def prolong_water(water, coarse_dem, dem):
+    # Fine water layer for a coarse one. Fine cells are filled up to the coarse water surface,
+    # then the water in each coarse cell is scaled back to the coarse depth so its volume is kept
+    # (exactly where bins hold whole fine cells). Coarse cells whose surface does not reach any
+    # fine cell spread their depth evenly
+    depth = np.maximum(prolong(coarse_dem + water, dem.shape) - dem, 0)
+    coarse_depth = resize_array(depth, *water.shape)
+
+    filled = coarse_depth > 0
+    ratio = np.divide(water, coarse_depth, out = np.zeros_like(water), where = filled)
+
+    return depth * prolong(ratio, dem.shape) + prolong(np.where(filled, 0, water), dem.shape)
+
+def coarse_levels(shape, levels = 1, factor = 4):
+    # shapes of `levels` coarse levels, coarsest first, each factor times coarser than the next
+    rows, cols = shape
+    return [(max(rows // factor**k, 1), max(cols // factor**k, 1)) for k in range(levels, 0, -1)]
+
+def run_coarse_to_fine(dem, **kwargs):
+    # run_sim on the coarse levels of dem (coarse_levels or shapes = [(rows, cols), ...],
+    # coarsest first) for coarse_iter steps each, then for iter steps on dem itself.
+    # Other kwargs (tau, t, n, engine, avg, rng, ...) are passed to run_sim on every level.
+    # Returns the result of every level and the volume error of every handoff
+    fill = kwargs.pop('fill', 1)
+    kind = kwargs.pop('kind', 'border')
+    edgel = kwargs.pop('edgel', 1)
+    shapes = kwargs.pop('shapes', None) or coarse_levels(
+        dem.shape, kwargs.pop('levels', 1), kwargs.pop('factor', 4))
+    coarse_iter = kwargs.pop('coarse_iter', 60)
+    if np.isscalar(coarse_iter):
+        coarse_iter = [coarse_iter] * len(shapes)
+    target_cell = kwargs.pop('target_cell', [5,5])
+
+    fine = init_grid(dem, fill = fill, kind = kind, cache = kwargs.get('cache'))
+    key = dem_hash(dem)
+
+    # the initial water goes to the coarsest level, averaged over each bin keeps its volume
+    water = resize_array(fine[...,1], *shapes[0])
+
+    results, handoffs = [], []
+    for k, shape in enumerate(shapes + [dem.shape]):
+        level_dem = resample_dem(dem, *shape, key = key)
+        # a coarse cell is as large as the fine cells it averages
+        level_edgel = edgel * np.sqrt(dem.shape[0] / shape[0] * dem.shape[1] / shape[1])
+
+        if k > 0:
+            # hand the water of the previous level over
+            before = water.sum() * results[-1]['area']
+            water = prolong_water(water, results[-1]['dem'], level_dem)
+            after = water.sum() * level_edgel**2
+            handoffs.append({
+                'from': shapes[k - 1],
+                'to': shape,
+                'volume_before': before,
+                'volume_after': after,
+                'mass_error': after - before,
+                'relative_error': (after - before) / before if before else 0.})
+
+        basin = init_grid(level_dem, fill = 0, kind = 'everywhere', cache = kwargs.get('cache'))
+        basin[...,1] = water
+        level_iter = coarse_iter[k] if k < len(shapes) else kwargs.get('iter', 60)
+        level_target = [target_cell[0] * shape[0] // dem.shape[0], target_cell[1] * shape[1] // dem.shape[1]]
+
+        level = run_sim(basin, **{**kwargs, 'iter': level_iter, 'edgel': level_edgel, 'target_cell': level_target})
+        level['dem'] = level_dem
+        # tot_mass is a sum of depths, volume is comparable between levels
+        level['volume'] = level['tot_mass'] * level['area']
+        results.append(level)
+
+        water = level['final_levels']
+
+    # time already simulated when each level started
+    offsets = np.cumsum([0] + [level['sim_time'][-1] if level['steps'] else 0 for level in results[:-1]])
+
+    return {
+        'levels': results,
+        'shapes': shapes + [dem.shape],
+        'handoffs': handoffs,
+        'volume': np.concatenate([level['volume'] for level in results]),
+        'sim_time': np.concatenate([level['sim_time'] + offset for level, offset in zip(results, offsets)]),
+        'fine_steps': results[-1]['steps'],
+        'final_levels': results[-1]['final_levels'],
+        'duration': sum(level['duration'] for level in results),
+    }
@@ -0,0 +1,140 @@
+import numpy as np
+from numba import njit, prange, get_num_threads
+
+from src.profiling import timed, record_counters
+
+
+############################ Compiled CA update ################################################
+
+# Each step is split in two passes over row tiles so that no two threads write the same cell:
+#   1. every cell computes its own ic_vol and stores how much it sends per unit height difference
+#   2. every cell pulls its inflows from its upstream neighbours (gather instead of scatter)
+
+@njit(cache = True)
+def tile_bounds(tile, tile_rows, rows):
+    # first and last+1 row of a tile
+    return tile*tile_rows, min((tile+1)*tile_rows, rows)
+
+@njit(parallel = True, cache = True)
+def compute_outflows(water_heights, water, tau, t, n, g, edgel, tile_rows, scale, kept, max_velocity, max_moved, counters):
+    area = edgel*edgel
+    dist = edgel
+    rows, cols = water_heights.shape
+    n_tiles = (rows + tile_rows - 1) // tile_rows
+
+    for tile in prange(n_tiles):
+        first, last = tile_bounds(tile, tile_rows, rows)
+        # per-tile maxima, each tile only writes its own slot
+        max_velocity[tile] = 0.
+        max_moved[tile] = 0.
+        # cells with outflow, volume moved and largest ic_vol of the tile
+        counters[tile, 0] = 0.
+        counters[tile, 1] = 0.
+        counters[tile, 2] = 0.
+        for i in range(first, last):
+            for j in range(cols):
+                central_height = water_heights[i,j]
+
+                # total, min and max downstream volume
+                n_downstream = 0
+                v_tot_avail = 0.
+                v_min = np.inf
+                v_max = -np.inf
+                for dx in range(-1,2):
+                    for dy in range(-1,2):
+                        if 0 <= i+dx < rows and 0 <= j+dy < cols:
+                            neighbor_height = water_heights[i+dx,j+dy]
+                            # exclude no_data cells
+                            if neighbor_height > 0:
+                                diff = central_height - neighbor_height
+                                if diff - tau > 0:
+                                    vol = diff * area
+                                    n_downstream += 1
+                                    v_tot_avail += vol
+                                    v_min = min(v_min, vol)
+                                    v_max = max(v_max, vol)
+
+                if n_downstream > 0:
+                    w_max = v_max / (v_tot_avail + v_min)
+                else:
+                    # no downstream neighbours, everything stays in the cell
+                    v_min = 0.01
+                    v_max = 1e4
+                    w_max = 1.
+
+                min_weight = v_min / (v_tot_avail + v_min)
+
+                central_depth = water[i,j]
+                manning = 1/n * central_depth**(2/3) * np.sqrt(v_max / dist)
+                # maximum permissible velocity
+                vm = min(np.sqrt(central_depth*g), manning)
+                inter_cell_max = vm * central_depth * t * edgel
+                v_incell = central_depth * area
+
+                ic_vol = min(v_incell, inter_cell_max/w_max, v_min)
+
+                if n_downstream > 0:
+                    moved = ic_vol * (1 - min_weight)
+                    max_velocity[tile] = max(max_velocity[tile], vm)
+                    max_moved[tile] = max(max_moved[tile], moved)
+                    if moved > 0:
+                        counters[tile, 0] += 1
+                    counters[tile, 1] += moved
+                    counters[tile, 2] = max(counters[tile, 2], ic_vol)
+
+                # depth sent to a neighbour = scale * (height difference * area)
+                scale[i,j] = ic_vol / (v_tot_avail + v_min) / area
+                kept[i,j] = water[i,j] - ic_vol/area + ic_vol * min_weight / area
+
+@njit(parallel = True, cache = True)
+def gather_inflows(water_heights, tau, edgel, tile_rows, scale, kept, basin_copy):
+    area = edgel*edgel
+    rows, cols = water_heights.shape
+    n_tiles = (rows + tile_rows - 1) // tile_rows
+
+    for tile in prange(n_tiles):
+        first, last = tile_bounds(tile, tile_rows, rows)
+        for i in range(first, last):
+            for j in range(cols):
+                central_height = water_heights[i,j]
+                level = kept[i,j]
+
+                # a cell only receives water if it is not no_data
+                if central_height > 0:
+                    for dx in range(-1,2):
+                        for dy in range(-1,2):
+                            if 0 <= i+dx < rows and 0 <= j+dy < cols:
+                                # same test the upstream cell used to pick its downstream neighbours
+                                diff = water_heights[i+dx,j+dy] - central_height
+                                if diff - tau > 0:
+                                    level += scale[i+dx,j+dy] * diff * area
+
+                basin_copy[i,j] = level
+
+def step_tiles(dem, water, tau, t, n, g = 10, edgel = 1, tiles_per_thread = 4, state = None):
+    # One CA iteration on all cores, returns the new water layer
+    water_heights = dem + water
+    rows = water_heights.shape[0]
+
+    # a few tiles per thread so uneven tiles still balance out
+    n_tiles = max(1, get_num_threads() * tiles_per_thread)
+    tile_rows = max(1, -(-rows // n_tiles))
+
+    scale = np.empty_like(water_heights)
+    kept = np.empty_like(water_heights)
+    basin_copy = np.empty_like(water_heights)
+    max_velocity = np.zeros(n_tiles)
+    max_moved = np.zeros(n_tiles)
+    counters = np.zeros((n_tiles, 3))
+
+    with timed(state, 'outflows'):
+        compute_outflows(water_heights, water, tau, t, n, g, edgel, tile_rows, scale, kept, max_velocity, max_moved, counters)
+    with timed(state, 'gather'):
+        gather_inflows(water_heights, tau, edgel, tile_rows, scale, kept, basin_copy)
+
+    if state is not None:
+        state['max_velocity'] = float(max_velocity.max())
+        state['max_moved'] = float(max_moved.max())
+    record_counters(state, water.size, counters[:, 0].sum(), counters[:, 1].sum(), counters[:, 2].max())
+
+    return basin_copy
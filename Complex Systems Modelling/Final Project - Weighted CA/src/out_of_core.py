@@ -0,0 +1,160 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from src.CA import cell_outflows, gather_inflows, init_slope, init_directions
+
+
+############################ Out of core grid ##################################################
+
+# A grid on disk is a directory with one raw float64 file per layer and a grid.json with its shape.
+# Layers are opened as numpy.memmap and only ever read or written one tile (plus halo) at a time,
+# so resident memory depends on the tile size and not on the size of the DEM.
+
+LAYERS = ['dem', 'water', 'slope', 'directions']
+# scratch layers used while stepping: next water layer, outflow share and water kept per cell
+WORK_LAYERS = ['water_next', 'share', 'kept']
+
+def layer_path(path, layer):
+    return os.path.join(path, f'{layer}.dat')
+
+def tiles(shape, tile):
+    # (first row, last row + 1, first col, last col + 1) of every tile
+    rows, cols = shape
+    tile_rows, tile_cols = tile
+    for r0 in range(0, rows, tile_rows):
+        for c0 in range(0, cols, tile_cols):
+            yield r0, min(r0 + tile_rows, rows), c0, min(c0 + tile_cols, cols)
+
+def with_halo(bounds, shape):
+    # slices of a tile grown by one cell (where the grid allows), and of the tile within them
+    r0, r1, c0, c1 = bounds
+    rows, cols = shape
+    top, bottom = max(r0 - 1, 0), min(r1 + 1, rows)
+    left, right = max(c0 - 1, 0), min(c1 + 1, cols)
+
+    block = (slice(top, bottom), slice(left, right))
+    own = (slice(r0 - top, r1 - top), slice(c0 - left, c1 - left))
+    return block, own
+
+def open_grid(path, mode = 'r+'):
+    # Open every layer of a grid created with create_grid
+    with open(os.path.join(path, 'grid.json')) as f:
+        shape = tuple(json.load(f)['shape'])
+
+    grid = {layer: np.memmap(layer_path(path, layer), dtype = float, mode = mode, shape = shape)
+            for layer in LAYERS + WORK_LAYERS}
+    return grid
+
+def create_grid(path, dem, tile = (1024, 1024), **kwargs):
+    # Write a DEM (array or memmap) to path and initialise water, slope and directions tile by tile
+    fill = kwargs.get('fill', 1)
+    kind = kwargs.get('kind', 'border')
+    # water is filled in tile by tile, only these kinds of init_water are supported
+    if kind not in ('border', 'everywhere'):
+        raise ValueError(f"Unsupported kind {kind!r} for an out of core grid, expected 'border' or 'everywhere'")
+
+    os.makedirs(path, exist_ok = True)
+    shape = dem.shape
+    with open(os.path.join(path, 'grid.json'), 'w') as f:
+        json.dump({'shape': list(shape)}, f)
+
+    for layer in LAYERS + WORK_LAYERS:
+        np.memmap(layer_path(path, layer), dtype = float, mode = 'w+', shape = shape).flush()
+    grid = open_grid(path)
+
+    for bounds in tiles(shape, tile):
+        r0, r1, c0, c1 = bounds
+        grid['dem'][r0:r1, c0:c1] = dem[r0:r1, c0:c1]
+
+    for bounds in tiles(shape, tile):
+        r0, r1, c0, c1 = bounds
+        block, own = with_halo(bounds, shape)
+        # slope and directions only look one cell around, so the halo is enough
+        dem_block = np.asarray(grid['dem'][block])
+        grid['slope'][r0:r1, c0:c1] = init_slope(dem_block)[own]
+        grid['directions'][r0:r1, c0:c1] = init_directions(dem_block)[own]
+
+        # at the grid's border the tile's border is the grid's border, so directions stay 0 there
+        if kind == 'everywhere':
+            grid['water'][r0:r1, c0:c1] = fill
+
+    if kind == 'border':
+        grid['water'][0,:], grid['water'][-1,:] = fill, fill
+        grid['water'][:,0], grid['water'][:,-1] = fill, fill
+
+    for layer in grid.values():
+        layer.flush()
+
+    return grid
+
+def step_tiled(grid, tau, t, n, g = 10, edgel = 1, tile = (1024, 1024)):
+    # One iteration over every tile, writes the new water layer to grid['water_next']
+    shape = grid['dem'].shape
+    params = {'tau': tau, 't': t, 'n': n, 'g': g, 'edgel': edgel}
+
+    # pass 1: outflow share and water kept by each cell
+    for bounds in tiles(shape, tile):
+        r0, r1, c0, c1 = bounds
+        block, own = with_halo(bounds, shape)
+
+        water = np.asarray(grid['water'][block])
+        _, share, kept = cell_outflows(grid['dem'][block] + water, water, **params)
+        grid['share'][r0:r1, c0:c1] = share[own]
+        grid['kept'][r0:r1, c0:c1] = kept[own]
+
+    # pass 2: every cell gathers from its upstream neighbours, the share of the halo is now known
+    for bounds in tiles(shape, tile):
+        r0, r1, c0, c1 = bounds
+        block, own = with_halo(bounds, shape)
+
+        water_heights = grid['dem'][block] + grid['water'][block]
+        level = gather_inflows(water_heights, np.asarray(grid['share'][block]),
+                               np.asarray(grid['kept'][block]), tau)
+        grid['water_next'][r0:r1, c0:c1] = level[own]
+
+def run_tiled(grid, **kwargs):
+    # run_sim for a grid opened with open_grid, the final water layer is left in grid['water']
+    tau = kwargs.get('tau', 0.1)
+    t = kwargs.get('t', 1)
+    n = kwargs.get('n', 0.02)
+    g = kwargs.get('g', 10)
+    # cell size (m)
+    edgel = kwargs.get('edgel', 1)
+    iter = kwargs.get('iter', 60)
+    target_cell = kwargs.get('target_cell', [5,5])
+    tile = kwargs.get('tile', (1024, 1024))
+
+    shape = grid['dem'].shape
+    tot_mass = np.zeros(iter)
+    cell_water = np.zeros(iter)
+
+    start = time.time()
+    for it in range(iter):
+        step_tiled(grid, tau, t, n, g = g, edgel = edgel, tile = tile)
+
+        # copy the new layer back tile by tile, collecting the totals on the way
+        for r0, r1, c0, c1 in tiles(shape, tile):
+            level = np.asarray(grid['water_next'][r0:r1, c0:c1])
+            grid['water'][r0:r1, c0:c1] = level
+            tot_mass[it] += level.sum()
+
+        cell_water[it] = grid['water'][target_cell[0], target_cell[1]]
+        grid['water'].flush()
+
+    duration = time.time() - start
+
+    return {
+        'tot_mass': tot_mass,
+        'cell_water': cell_water,
+        'duration': duration,
+        'N': shape[0],
+        'shape': shape,
+        'iter': iter,
+        'tau': tau,
+        't': t,
+        'area': edgel*edgel,
+        'tile': tile,
+    }
@@ -1,9 +1,12 @@
 # Import everything 
 from matplotlib import pyplot as plt
-from matplotlib import cm
+from matplotlib import animation
+from matplotlib.colors import LightSource, to_rgba_array
+from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 
 import numpy as np
 from src.CA import make_direction_dict, get_direction_idxs, get_direction_keys
+from src.snapshots import read_snapshots
 
 def dist(
     layer,
@@ -70,47 +73,140 @@ def adjust_spines(ax, spines, offset = 0):
             ax.xaxis.set_ticks([])
 
 
-def plot_dem(dem, rotation = 30,  cmap = 'binary', ax = None):
-    # A function that plots a DEM (or any 2d array) in 3d
+############################ 2.5D rendering ###################################################
+
+# mode = 'bars' draws one bar3d bar per cell. mode = 'surface' draws each layer as a single mesh
+# through the cell centres, coloured with one colormap lookup over the whole array, which is much
+# faster to build and to draw. WaterView keeps the terrain and updates the water mesh in place.
+
+# water shallower than this (m) is not drawn
+WET_DEPTH = 1e-2
+
+def height_colors(z, cmap):
+    # rgba of every value of z, normalised like the bars always were
+    return plt.get_cmap(cmap)((z - np.min(z)) / np.max(z))
+
+def bar_anchors(shape):
+    # x, y of the corner of each cell's bar, i along x and j along y
+    xpos, ypos = np.meshgrid(np.arange(shape[0]) + 0.1, np.arange(shape[1]) + 0.1, indexing = 'ij')
+    return xpos.ravel(), ypos.ravel()
+
+def surface_quads(z):
+    # (rows-1)*(cols-1) quads between neighbouring cell centres of a height map, shape (n, 4, 3)
+    rows, cols = z.shape
+    i, j = np.meshgrid(np.arange(rows) + 0.5, np.arange(cols) + 0.5, indexing = 'ij')
+    points = np.stack([i, j, z], axis = -1)
+
+    return np.stack([points[:-1,:-1], points[1:,:-1], points[1:,1:], points[:-1,1:]], axis = 2).reshape(-1, 4, 3)
+
+def quad_values(a, reduce = np.mean):
+    # one value per surface_quads quad from its four corners
+    corners = np.stack([a[:-1,:-1], a[1:,:-1], a[1:,1:], a[:-1,1:]])
+    return reduce(corners, axis = 0).ravel()
+
+# the light bar3d shades its faces with
+LIGHT = LightSource(azdeg = 225, altdeg = 19.4712)
+
+def shade_quads(colors, quads):
+    # darken the colour of each quad by how far it faces away from the light, like bar3d does
+    normals = np.cross(quads[:,2] - quads[:,0], quads[:,3] - quads[:,1])
+    facing = (normals / np.linalg.norm(normals, axis = 1, keepdims = True)) @ LIGHT.direction
+
+    shaded = np.array(to_rgba_array(colors), dtype = float) * np.ones((len(quads), 1))
+    # facing in [-1, 1] -> brightness in [0.3, 1]
+    shaded[:,:3] *= (0.65 + 0.35 * facing)[:,None]
+    return shaded
+
+def style_axes(ax, rotation):
+    # show from side
+    ax.view_init(elev=rotation, azim= -90 + rotation)
+    # remove axes and ticks
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.set_zticks([])
+
+def surface(ax, z, colors, zorder = 1):
+    # add a mesh of z as a single artist
+    quads = surface_quads(z)
+    mesh = Poly3DCollection(quads, facecolors = shade_quads(colors, quads), linewidths = 0, zorder = zorder)
+    ax.add_collection3d(mesh)
+
+    rows, cols = z.shape
+    ax.set_xlim(0, rows)
+    ax.set_ylim(0, cols)
+    ax.set_zlim(min(np.min(z), 0), np.max(z))
+    return mesh
+
+class WaterView:
+    # plot_water(mode = 'surface') drawn once and updated between frames: the terrain is one mesh,
+    # the water surface (dem + water over wet cells) another whose vertices are replaced by update
+    def __init__(self, dem, rotation = 30, ax = None, cmap = 'Greys') -> None:
+        if not ax:
+            fig = plt.figure()
+            ax = fig.add_subplot(projection='3d')
+        self.ax = ax
+        self.dem = np.asarray(dem, dtype = float)
+
+        # water is drawn over the terrain, like the stacked bars
+        ax.computed_zorder = False
+        self.terrain = surface(ax, self.dem, height_colors(quad_values(self.dem), cmap), zorder = 1)
+        self.water = None
+        style_axes(ax, rotation)
+
+    def update(self, water, new = False):
+        # Show water, returns the water artist. new = True adds another artist instead of
+        # changing the current one, for matplotlib.animation.ArtistAnimation frames
+        surface_z = self.dem + water
+        wet = quad_values(np.asarray(water), np.max) > WET_DEPTH
+        quads = surface_quads(surface_z)[wet]
+
+        colors = shade_quads('blue', quads)
+        if self.water is None or new:
+            self.water = Poly3DCollection(quads, facecolors = colors, linewidths = 0, zorder = 2)
+            self.ax.add_collection3d(self.water)
+        else:
+            self.water.set_verts(quads)
+            self.water.set_facecolor(colors)
 
-    bins = dem.shape[0]
-    dem = dem.flatten()
+        # keep the highest water in view
+        if np.max(surface_z) > self.ax.get_zlim()[1]:
+            self.ax.set_zlim(top = np.max(surface_z))
+        return self.water
+
+
+def plot_dem(dem, rotation = 30,  cmap = 'binary', ax = None, mode = 'bars'):
+    # A function that plots a DEM (or any 2d array) in 3d
+    # mode = 'surface' draws a single mesh instead of a bar per cell
 
     if not ax:
         fig = plt.figure()
         ax = fig.add_subplot(projection='3d')
 
-    hist, xedges, yedges = np.histogram2d(dem, dem, bins=bins, range=[[0, bins], [0, bins]])
+    if mode == 'surface':
+        dem = np.asarray(dem, dtype = float)
+        lc = surface(ax, dem, height_colors(quad_values(dem), cmap))
+        style_axes(ax, rotation)
+        return lc
 
     # Figure out anchors for each bar
-    xpos, ypos = np.meshgrid(xedges[:-1] + 0.1, yedges[:-1] + 0.1, indexing="ij")
-    xpos = xpos.ravel()
-    ypos = ypos.ravel()
+    xpos, ypos = bar_anchors(dem.shape)
     zpos = 0
 
     # Construct arrays with the dimensions for each bar
     dx = dy = 1 * np.ones_like(zpos)
-    dz = dem
+    dz = dem.flatten()
 
-    cmap = cm.get_cmap(cmap) # discrete colormap
-    max_height = np.max(dz)   # max height
-    min_height = np.min(dz)    
     # normalize each z to [0,1], and get their rgb values
-    rgba = [cmap((k-min_height)/max_height) for k in dz] 
+    rgba = height_colors(dz, cmap)
 
     lc = ax.bar3d(xpos, ypos, zpos, dx, dy, dz, color = rgba, zsort='average')
 
-    # show from side
-    ax.view_init(elev=rotation, azim= -90 + rotation)
-    # remove axes and ticks
-    ax.set_xticks([])
-    ax.set_yticks([])
-    ax.set_zticks([])
+    style_axes(ax, rotation)
 
     return lc
 
 # A function that plots a DEM heightmap in 4 angles
-def orbit_dem(dem, n = 4, cmap = 'Greys_r'):
+def orbit_dem(dem, n = 4, cmap = 'Greys_r', mode = 'bars'):
     # Plot a DEM from different n angles
     # init 3d subplots
     # A figure with a grid of subplots, no margin
@@ -118,7 +214,7 @@ def orbit_dem(dem, n = 4, cmap = 'Greys_r'):
     for i in range(n):
         ax = fig.add_subplot(n, 4, i+1, projection='3d')
         rot = 90 * i/n
-        lc = plot_dem(dem, rot, cmap, ax)
+        lc = plot_dem(dem, rot, cmap, ax, mode = mode)
 
     # Make layout compact
     fig.colorbar(lc, ax = ax, shrink = 0.8)
@@ -127,69 +223,38 @@ def orbit_dem(dem, n = 4, cmap = 'Greys_r'):
     return fig
 
 
-def plot_water(dem, water, rotation = 30,  cmap = 'binary', ax = None):
+def plot_water(dem, water, rotation = 30,  cmap = 'binary', ax = None, mode = 'bars'):
     # A function that plots a DEM (or any 2d array) in 3d
+    # with the water stacked over it. mode = 'surface' draws a WaterView instead of bars,
+    # keep the WaterView to redraw other water layers faster
 
-    bins = dem.shape[0]
-    dem = dem.flatten()
+    if mode == 'surface':
+        return WaterView(dem, rotation, ax).update(water)
 
     if not ax:
         fig = plt.figure()
         ax = fig.add_subplot(projection='3d')
 
-    hist, xedges, yedges = np.histogram2d(dem, dem, bins=bins, range=[[0, bins], [0, bins]])
-
     # Figure out anchors for each bar
-    xpos, ypos = np.meshgrid(xedges[:-1] + 0.1, yedges[:-1] + 0.1, indexing="ij")
-    xpos = xpos.ravel()
-    ypos = ypos.ravel()
+    xpos, ypos = bar_anchors(dem.shape)
     zpos = 0
 
     # Construct arrays with the dimensions for each bar
     dx = dy = 1 * np.ones_like(zpos)
-    dz = dem
+    dz = dem.flatten()
 
-    cmap = cm.get_cmap("Greys") # discrete colormap
-    max_height = np.max(dz)   # max height
-    min_height = np.min(dz)    
     # normalize each z to [0,1], and get their rgb values
-    rgba = [cmap((k-min_height)/max_height) for k in dz] 
+    rgba = height_colors(dz, "Greys")
 
     lc = ax.bar3d(xpos, ypos, zpos, dx, dy, dz, color = rgba, alpha = 1, zsort='average')
 
-    # show from side
-    ax.view_init(elev=rotation, azim= -90 + rotation)
-    # remove axes and ticks
-    ax.set_xticks([])
-    ax.set_yticks([])
-    ax.set_zticks([])
-
+    style_axes(ax, rotation)
 
     # Now stack the water map
-    bins = water.shape[0]
-    water = water.flatten()
-
-    if not ax:
-        fig = plt.figure()
-        ax = fig.add_subplot(projection='3d')
+    dz1 = water.flatten()
 
-    hist, xedges, yedges = np.histogram2d(water, water, bins=bins, range=[[0, bins], [0, bins]])
-
-    # Figure out anchors for each bar
-    xpos, ypos = np.meshgrid(xedges[:-1] + 0.1, yedges[:-1] + 0.1, indexing="ij")
-    xpos = xpos.ravel()
-    ypos = ypos.ravel()
-    zpos = 0
-
-    # Construct arrays with the dimensions for each bar
-    dx = dy = 1 * np.ones_like(zpos)
-    dz1 = water
-
-    cmap = cm.get_cmap("Blues") # discrete colormap
-    max_height = np.max(dz1)   # max height
-    min_height = np.min(dz1[dz1 > 1e-5])   
-    #normalize each z to [0,1], and get their rgb values
-    rgba = ["blue" if k > 1e-2 else (1,1,1,0) for k in dz1] 
+    # wet cells are blue, dry ones transparent
+    rgba = np.where((dz1 > WET_DEPTH)[:,None], (0, 0, 1, 1), (1, 1, 1, 0))
 
     # stack over previous 3d barplot
     lc = ax.bar3d(xpos, ypos, dz, dx, dy, dz1, color = rgba, alpha = 1, zsort='average')
@@ -197,6 +262,34 @@ def plot_water(dem, water, rotation = 30,  cmap = 'binary', ax = None):
     return lc
 
 
+def animate_snapshots(path, dem, rotation = 30, interval = 200, mode = 'bars'):
+    # Render a snapshot store written by run_sim(..., sink = SnapshotSink(path)).
+    # Frames are read from disk and drawn one at a time when the animation is saved or shown.
+    # mode = 'surface' draws the terrain once and only moves the water mesh between frames
+    fig = plt.figure()
+    ax = fig.add_subplot(111, projection='3d')
+    view = WaterView(dem, rotation, ax) if mode == 'surface' else None
+
+    def draw(snapshot):
+        step, time, water = snapshot
+        if view is None:
+            ax.clear()
+            lc = plot_water(dem, water, rotation = rotation, ax = ax)
+        else:
+            lc = view.update(water)
+        ax.set_title(f'Step {step} ({time:g} s)')
+        return [lc]
+
+    anim = animation.FuncAnimation(
+        fig,
+        draw,
+        frames = read_snapshots(path),
+        interval = interval,
+        cache_frame_data = False,
+        save_count = None)
+    plt.close(fig)
+
+    return anim
 
 
 # transform ij indexing to cartesian xy
@@ -0,0 +1,126 @@
+import json
+import time
+
+
+############################ Instrumentation ###################################################
+
+# run_sim(..., profile = Profiler()) times each phase of every iteration (rain, the engine's
+# neighbour scan, weights and scatter, mass bookkeeping, plotting, ...) and keeps per-iteration
+# counters reported by the engines. Engines find the profiler in their state dict; without one,
+# timed() hands out a shared no-op context manager and the counters are never computed.
+
+class NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_PHASE = NullPhase()
+
+class Phase:
+    def __init__(self, profile, name) -> None:
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.profile.spans.append((self.name, self.profile.iteration, self.start, end - self.start))
+        return False
+
+class Profiler:
+    def __init__(self) -> None:
+        # (phase, iteration, start, duration) of every timed phase
+        self.spans = []
+        # counters of each iteration
+        self.counters = {}
+        self.iteration = None
+        self.origin = time.perf_counter()
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def start_iteration(self, it):
+        self.iteration = it
+
+    def count(self, **counters):
+        # add to the counters of the current iteration (trial stacks and tiles report parts)
+        current = self.counters.setdefault(self.iteration, {})
+        for key, value in counters.items():
+            if key.startswith('max_'):
+                current[key] = max(current.get(key, value), value)
+            else:
+                current[key] = current.get(key, 0) + value
+
+    def phases(self):
+        # names of the timed phases in the order they first ran
+        return list(dict.fromkeys(name for name, _, _, _ in self.spans))
+
+    def table(self):
+        # One row per iteration: seconds spent in each phase and the counters
+        rows = {}
+        for name, it, _, duration in self.spans:
+            if it is not None:
+                row = rows.setdefault(it, {'iteration': it})
+                row[f'{name}_s'] = row.get(f'{name}_s', 0) + duration
+        for it, counters in self.counters.items():
+            if it is not None:
+                rows.setdefault(it, {'iteration': it}).update(counters)
+
+        return [rows[it] for it in sorted(rows)]
+
+    def summary(self):
+        # total seconds per phase
+        totals = {}
+        for name, _, _, duration in self.spans:
+            totals[name] = totals.get(name, 0) + duration
+        return totals
+
+    def write_table(self, path):
+        # per-iteration table as csv
+        rows = self.table()
+        columns = list(dict.fromkeys(key for row in rows for key in row))
+        with open(path, 'w') as f:
+            f.write(','.join(columns) + '\n')
+            for row in rows:
+                f.write(','.join(str(row.get(key, '')) for key in columns) + '\n')
+
+    def write_chrome_trace(self, path):
+        # Spans and counters in the Chrome trace event format (chrome://tracing, Perfetto)
+        events = [{
+            'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+            'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6,
+            'args': {'iteration': it}} for name, it, start, duration in self.spans]
+
+        # counters are drawn at the start of their iteration
+        starts = {}
+        for _, it, start, _ in self.spans:
+            starts[it] = min(starts.get(it, start), start)
+        events += [{
+            'name': key, 'ph': 'C', 'pid': 0, 'tid': 0,
+            'ts': (starts.get(it, self.origin) - self.origin) * 1e6, 'args': {key: value}}
+            for it, counters in self.counters.items() for key, value in counters.items()]
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+def timed(state, name):
+    # context manager timing a phase if the run is profiled
+    profile = None if state is None else state.get('profile')
+    return NULL_PHASE if profile is None else profile.phase(name)
+
+def counting(state):
+    return state is not None and state.get('profile') is not None
+
+def record_counters(state, active_cells, outflow_cells, volume_moved, max_ic_vol):
+    # per-iteration counters of an engine, ignored if the run is not profiled
+    if counting(state):
+        state['profile'].count(
+            active_cells = int(active_cells),
+            outflow_cells = int(outflow_cells),
+            volume_moved = float(volume_moved),
+            max_ic_vol = float(max_ic_vol))
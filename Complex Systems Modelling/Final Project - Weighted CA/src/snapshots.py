@@ -0,0 +1,101 @@
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+############################ Snapshot store ####################################################
+
+# A snapshot store is a directory with a meta.json and compressed chunk files chunk_00000.npz, ...
+# Each chunk holds up to `chunk` water layers together with the step and simulated time they
+# were taken at. Chunks are written by a background thread, so the stepping loop only pays for
+# copying the layer.
+
+def chunk_path(path, k):
+    return os.path.join(path, f'chunk_{k:05d}.npz')
+
+class SnapshotSink:
+    # Observer for run_sim(..., sink = sink, interval = k): write() is called with the water
+    # layer every k steps. Use as a context manager, or call close() to wait for the writer.
+    def __init__(self, path, chunk = 32, dtype = np.float32, max_pending = 4) -> None:
+        self.path = path
+        self.chunk = chunk
+        self.dtype = dtype
+        os.makedirs(path, exist_ok = True)
+
+        self.buffer = []
+        self.n_chunks = 0
+        self.shape = None
+        self.error = None
+
+        # bounded, so a slow disk slows the simulation instead of filling memory
+        self.pending = queue.Queue(maxsize = max_pending)
+        self.writer = threading.Thread(target = self.write_chunks, daemon = True)
+        self.writer.start()
+
+    def write(self, step, water, time = None):
+        # Queue a copy of the water layer taken after `step` steps
+        if self.error:
+            raise self.error
+
+        self.shape = water.shape
+        self.buffer.append((step, step if time is None else time, np.array(water, dtype = self.dtype)))
+        if len(self.buffer) == self.chunk:
+            self.flush()
+
+    def flush(self):
+        # hand the buffered snapshots to the writer thread
+        if self.buffer:
+            self.pending.put((self.n_chunks, self.buffer))
+            self.n_chunks += 1
+            self.buffer = []
+
+    def write_chunks(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            k, snapshots = item
+            try:
+                steps, times, layers = zip(*snapshots)
+                np.savez_compressed(
+                    chunk_path(self.path, k),
+                    steps = np.array(steps),
+                    time = np.array(times),
+                    water = np.stack(layers))
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        # write what is left and wait for the writer to finish
+        self.flush()
+        self.pending.put(None)
+        self.writer.join()
+
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({
+                'shape': list(self.shape or ()),
+                'dtype': np.dtype(self.dtype).name,
+                'chunk': self.chunk,
+                'chunks': self.n_chunks}, f)
+
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_snapshots(path):
+    # Yield (step, time, water) from a snapshot store, one chunk in memory at a time
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    for k in range(meta['chunks']):
+        with np.load(chunk_path(path, k)) as chunk:
+            for step, time, water in zip(chunk['steps'], chunk['time'], chunk['water']):
+                yield step, time, water